@@ -4,10 +4,73 @@ import os
 from PIL import Image
 import numpy as np
 from pydub import AudioSegment
-from moviepy.editor import ImageClip, VideoFileClip, AudioFileClip, CompositeVideoClip, concatenate_videoclips
+from moviepy.editor import VideoClip, VideoFileClip, AudioFileClip, CompositeAudioClip, CompositeVideoClip
+import collections
+import concurrent.futures
+import hashlib
 import io
+import json
+import math
+import queue
+import shutil
+import socket
 import subprocess
 import sys
+import threading
+import time
+import uuid
+import zipfile
+
+def read_audio_file(audio_file):
+    """ファイル拡張子に基づいて音声ファイルを読み込む（Streamlitの表示は行わず、失敗時は原因を含む例外を送出する）"""
+    if audio_file.endswith('.wav'):
+        return AudioSegment.from_wav(audio_file)
+    elif audio_file.endswith('.mp3'):
+        try:
+            return AudioSegment.from_mp3(audio_file)
+        except Exception as mp3_error:
+            raise RuntimeError(f"MP3ファイルの処理にはFFmpegが必要です。WAVファイルをお試しください。（詳細: {mp3_error}）") from mp3_error
+    else:
+        # 自動判定を試行
+        try:
+            return AudioSegment.from_file(audio_file)
+        except Exception as file_error:
+            raise RuntimeError(f"対応していない音声形式です。WAVまたはMP3ファイルをお試しください。（詳細: {file_error}）") from file_error
+
+def load_audio_segment(audio_file, debug_mode=False):
+    """ファイル拡張子に基づいて音声ファイルを読み込む（読み込めない形式の場合はエラーを表示してNoneを返す）"""
+    if debug_mode:
+        if audio_file.endswith('.wav'):
+            st.write("🔍 [DEBUG] WAVファイルとして読み込み中...")
+        elif audio_file.endswith('.mp3'):
+            st.write("🔍 [DEBUG] MP3ファイルとして読み込み中...")
+        else:
+            st.write("🔍 [DEBUG] ファイル形式自動判定中...")
+    
+    # WAVの読み込みエラー（RuntimeError以外）は呼び出し側で扱う
+    try:
+        return read_audio_file(audio_file)
+    except RuntimeError as e:
+        st.error(str(e))
+        return None
+
+def voice_chunks(audio, threshold_silence=-40, chunk_length=100):
+    """音声をchunk_length(ms)ごとに区切り、発音しているかどうかのリストを返す"""
+    chunks = []
+    for i in range(0, len(audio), chunk_length):
+        chunk = audio[i:i + chunk_length]
+        if len(chunk) > 0:
+            chunks.append(chunk.dBFS > threshold_silence)
+        else:
+            chunks.append(False)
+    return chunks
+
+def analyze_voice_file(audio_file, threshold_silence=-40):
+    """detect_voice_segmentsと同じ解析をStreamlitの表示なしで行う（バックグラウンドのスレッド用、失敗時は例外を送出する）"""
+    audio = read_audio_file(audio_file)
+    if len(audio) == 0:
+        raise RuntimeError("音声ファイルが空であるか、読み込めませんでした。")
+    return voice_chunks(audio, threshold_silence), len(audio) / 1000.0
 
 def detect_voice_segments(audio_file, threshold_silence=-40, debug_mode=False):
     """音声ファイルから発音区間を検出する"""
@@ -16,30 +79,9 @@ def detect_voice_segments(audio_file, threshold_silence=-40, debug_mode=False):
             st.write(f"🔍 [DEBUG] 音声ファイル読み込み開始: {os.path.basename(audio_file)}")
             st.write(f"🔍 [DEBUG] ファイルサイズ: {os.path.getsize(audio_file)} bytes")
         
-        # ファイル拡張子に基づいて適切な読み込み方法を選択
-        if audio_file.endswith('.wav'):
-            if debug_mode:
-                st.write("🔍 [DEBUG] WAVファイルとして読み込み中...")
-            audio = AudioSegment.from_wav(audio_file)
-        elif audio_file.endswith('.mp3'):
-            if debug_mode:
-                st.write("🔍 [DEBUG] MP3ファイルとして読み込み中...")
-            try:
-                audio = AudioSegment.from_mp3(audio_file)
-            except Exception as mp3_error:
-                st.error("MP3ファイルの処理にはFFmpegが必要です。WAVファイルをお試しください。")
-                st.error(f"詳細: {mp3_error}")
-                return [], 0
-        else:
-            # 自動判定を試行
-            if debug_mode:
-                st.write("🔍 [DEBUG] ファイル形式自動判定中...")
-            try:
-                audio = AudioSegment.from_file(audio_file)
-            except Exception as file_error:
-                st.error("対応していない音声形式です。WAVまたはMP3ファイルをお試しください。")
-                st.error(f"詳細: {file_error}")
-                return [], 0
+        audio = load_audio_segment(audio_file, debug_mode)
+        if audio is None:
+            return [], 0
         
         if debug_mode:
             st.write(f"🔍 [DEBUG] 音声読み込み成功!")
@@ -53,18 +95,12 @@ def detect_voice_segments(audio_file, threshold_silence=-40, debug_mode=False):
             return [], 0
         
         # dBFSでの音量レベルを取得
-        chunks = []
         chunk_length = 100  # 100ms単位で分析
         
         if debug_mode:
             st.write(f"🔍 [DEBUG] 音声解析中... ({chunk_length}ms間隔)")
         
-        for i in range(0, len(audio), chunk_length):
-            chunk = audio[i:i + chunk_length]
-            if len(chunk) > 0:
-                chunks.append(chunk.dBFS > threshold_silence)
-            else:
-                chunks.append(False)
+        chunks = voice_chunks(audio, threshold_silence, chunk_length)
         
         if debug_mode:
             speaking_chunks = sum(chunks)
@@ -81,77 +117,742 @@ def detect_voice_segments(audio_file, threshold_silence=-40, debug_mode=False):
             st.error(f"🔍 [DEBUG] トレースバック:\n{traceback.format_exc()}")
         return [], 0
 
-def create_mouth_animation_video(audio_file, mouth_closed_img, mouth_open_img, output_path, debug_mode=False, max_image_size=512, voice_threshold=-40):
-    """口パク動画を生成する"""
-    try:
-        if debug_mode:
-            st.write("🔍 [DEBUG] 動画生成開始")
-            st.write(f"🔍 [DEBUG] 音声ファイル: {audio_file}")
-            st.write(f"🔍 [DEBUG] 出力パス: {output_path}")
+def fit_avatar_size(image_sizes, max_image_size=512):
+    """口閉じ・口開き画像をそろえるサイズ（大きい方に合わせ、アスペクト比を保って最大サイズに収める）を返す"""
+    max_width = max(width for width, _ in image_sizes)
+    max_height = max(height for _, height in image_sizes)
+    
+    if max_width > max_image_size or max_height > max_image_size:
+        ratio = min(max_image_size / max_width, max_image_size / max_height)
+        return int(max_width * ratio), int(max_height * ratio)
+    return max_width, max_height
+
+def prepare_avatar_images(mouth_closed_img, mouth_open_img, max_image_size=512, debug_mode=False, keep_alpha=False):
+    """口閉じ・口開き画像を読み込み、同じサイズに揃えた画像のペアを返す"""
+    if debug_mode:
+        st.write("🔍 [DEBUG] 画像読み込み開始...")
+    
+    closed_img = Image.open(mouth_closed_img)
+    open_img = Image.open(mouth_open_img)
+    
+    if debug_mode:
+        st.write(f"🔍 [DEBUG] 口閉じ画像: {closed_img.size} {closed_img.mode}")
+        st.write(f"🔍 [DEBUG] 口開き画像: {open_img.size} {open_img.mode}")
+    
+    # 画像サイズを統一（大きい方に合わせる）
+    max_width = max(closed_img.width, open_img.width)
+    max_height = max(closed_img.height, open_img.height)
+    
+    if debug_mode:
+        st.write(f"🔍 [DEBUG] 統一サイズ: {max_width}x{max_height}")
+    
+    # メモリ使用量を抑えるため、画像サイズを制限
+    MAX_DIMENSION = max_image_size  # ユーザーが設定した最大サイズ
+    original_width, original_height = max_width, max_height
+    
+    if max_width > MAX_DIMENSION or max_height > MAX_DIMENSION:
+        # アスペクト比を保持しながらリサイズ
+        new_width, new_height = fit_avatar_size([closed_img.size, open_img.size], MAX_DIMENSION)
+        ratio = new_width / max_width
+        max_width, max_height = new_width, new_height
+        
+        # ユーザーに自動リサイズを通知
+        st.info(f"📏 **画像サイズ自動調整**: {original_width}×{original_height} → {new_width}×{new_height}")
+        st.info(f"💡 メモリ使用量削減のため、アスペクト比を保持したまま{MAX_DIMENSION}px以下にリサイズしました")
         
-        # 音声の発音区間を検出
         if debug_mode:
-            st.write("🔍 [DEBUG] 音声解析開始...")
+            st.write(f"🔍 [DEBUG] 画像サイズを制限: {new_width}x{new_height} (リサイズ比率: {ratio:.2f})")
+    else:
+        st.success(f"✅ **画像サイズ**: {max_width}×{max_height} （{MAX_DIMENSION}px以下のため調整不要）")
+    
+    # 画像をリサイズ
+    closed_img = closed_img.resize((max_width, max_height), Image.Resampling.LANCZOS)
+    open_img = open_img.resize((max_width, max_height), Image.Resampling.LANCZOS)
+    
+    if keep_alpha:
+        # 透過を残す（オーバーレイ用の書き出しなど）
+        closed_img = closed_img.convert('RGBA')
+        open_img = open_img.convert('RGBA')
+    else:
+        # RGBAをRGBに変換してメモリ使用量を25%削減
+        if closed_img.mode == 'RGBA':
+            closed_img = closed_img.convert('RGB')
+        if open_img.mode == 'RGBA':
+            open_img = open_img.convert('RGB')
+    
+    if debug_mode:
+        st.write(f"🔍 [DEBUG] 最終画像設定: {max_width}x{max_height}, モード: {closed_img.mode}")
+    
+    return closed_img, open_img
+
+def build_mouth_timeline(voice_segments, total_frames, fps=30, frame_switch_interval=3):
+    """フレームごとの口の状態を返す（True=口開き）"""
+    frame_duration = 1.0 / fps
+    mouth_states = []
+    
+    for frame_idx in range(total_frames):
+        current_time = frame_idx * frame_duration
+        segment_index = min(int(current_time * 10), len(voice_segments) - 1)  # 100ms単位のチャンク
         
-        voice_segments, duration = detect_voice_segments(audio_file, voice_threshold, debug_mode)
+        # 発音区間かどうかチェック
+        is_speaking = 0 <= segment_index < len(voice_segments) and voice_segments[segment_index]
         
-        if debug_mode:
-            st.write(f"🔍 [DEBUG] 音声解析完了 - 長さ: {duration}秒, セグメント数: {len(voice_segments)}")
+        if is_speaking:
+            # 発音区間では一定フレームごとに口の開閉を切り替え
+            mouth_states.append((frame_idx // frame_switch_interval) % 2 == 1)
+        else:
+            # 無音区間では口を閉じる
+            mouth_states.append(False)
+    
+    return mouth_states
+
+def mouth_state_changes(mouth_states, fps=30):
+    """口の状態が変化した時刻(ms)と状態(1=口開き, 0=口閉じ)のリストを返す"""
+    changes = []
+    previous_state = None
+    
+    for frame_idx, state in enumerate(mouth_states):
+        if state != previous_state:
+            changes.append([round(frame_idx * 1000 / fps), 1 if state else 0])
+            previous_state = state
+    
+    return changes
+
+def plan_silence_cuts(voice_timelines, max_silence_chunks):
+    """全キャラクターが無音の区間のうち、max_silence_chunksより長いものを詰めたときに残すチャンク区間[(開始, 終了)]を返す
+    
+    詰める区間は前後を半分ずつ残し、発話の直前・直後の間を保つ
+    """
+    chunk_count = max(len(voice_segments) for voice_segments in voice_timelines)
+    
+    def is_silent(chunk_idx):
+        return not any(chunk_idx < len(voice_segments) and voice_segments[chunk_idx] for voice_segments in voice_timelines)
+    
+    kept_ranges = []
+    range_start = 0
+    chunk_idx = 0
+    while chunk_idx < chunk_count:
+        if not is_silent(chunk_idx):
+            chunk_idx += 1
+            continue
+        
+        silence_start = chunk_idx
+        while chunk_idx < chunk_count and is_silent(chunk_idx):
+            chunk_idx += 1
+        
+        if chunk_idx - silence_start > max_silence_chunks:
+            head = max_silence_chunks // 2
+            kept_ranges.append((range_start, silence_start + head))
+            range_start = chunk_idx - (max_silence_chunks - head)
+    kept_ranges.append((range_start, chunk_count))
+    
+    return [(start, end) for start, end in kept_ranges if end > start]
+
+def cut_audio_file(audio_file, kept_ranges, output_path, chunk_length=100, debug_mode=False):
+    """残すチャンク区間だけをつないだ音声をWAVで書き出し、その長さ(秒)を返す"""
+    audio = load_audio_segment(audio_file, debug_mode)
+    if audio is None:
+        raise RuntimeError(f"音声ファイルを読み込めませんでした: {os.path.basename(audio_file)}")
+    
+    # クロスフェードを入れると区間ごとに長さが縮んで映像とずれるため、そのままつなぐ（切れ目は無音なので目立たない）
+    cut_audio = AudioSegment.empty()
+    for start, end in kept_ranges:
+        cut_audio += audio[start * chunk_length:end * chunk_length]
+    cut_audio.export(output_path, format='wav')
+    
+    return len(cut_audio) / 1000.0
+
+def export_lipsync_manifest(audio_file, mouth_closed_img, mouth_open_img, output_dir, debug_mode=False, max_image_size=512, voice_threshold=-40, use_sprite_sheet=False, raise_errors=False):
+    """動画をエンコードせず、口パクのタイミングマニフェスト(JSON)とアバター画像を書き出す
+    
+    raise_errors=Trueの場合（Streamlitの画面がないワーカーなど）は、エラーを表示せず原因を含む例外を送出する
+    """
+    try:
+        if raise_errors:
+            voice_segments, duration = analyze_voice_file(audio_file, voice_threshold)
+        else:
+            voice_segments, duration = detect_voice_segments(audio_file, voice_threshold, debug_mode)
         
         if duration == 0:
             st.error("音声ファイルの長さが取得できませんでした")
             return False
         
-        # 画像を読み込み
-        if debug_mode:
-            st.write("🔍 [DEBUG] 画像読み込み開始...")
+        # オーバーレイで使えるよう透過を残したまま準備
+        closed_img, open_img = prepare_avatar_images(mouth_closed_img, mouth_open_img, max_image_size, debug_mode, keep_alpha=True)
+        width, height = closed_img.size
+        
+        # 動画生成と同じロジックで口の状態を計算
+        fps = 30
+        total_frames = int(duration * fps)
+        mouth_states = build_mouth_timeline(voice_segments, total_frames, fps)
+        changes = mouth_state_changes(mouth_states, fps)
+        
+        os.makedirs(output_dir, exist_ok=True)
+        
+        manifest = {
+            "version": 1,
+            "fps": fps,
+            "duration_ms": round(duration * 1000),
+            "width": width,
+            "height": height,
+            # [時刻(ms), 状態(1=口開き, 0=口閉じ)] の配列
+            "changes": changes,
+        }
         
-        closed_img = Image.open(mouth_closed_img)
-        open_img = Image.open(mouth_open_img)
+        if use_sprite_sheet:
+            # 口閉じ・口開きを横に並べた1枚の画像にまとめる
+            sprite = Image.new('RGBA', (width * 2, height), (0, 0, 0, 0))
+            sprite.paste(closed_img, (0, 0))
+            sprite.paste(open_img, (width, 0))
+            sprite.save(os.path.join(output_dir, 'sprite.png'), optimize=True)
+            manifest["sprite"] = {
+                "file": "sprite.png",
+                "closed": {"x": 0, "y": 0, "w": width, "h": height},
+                "open": {"x": width, "y": 0, "w": width, "h": height},
+            }
+        else:
+            closed_img.save(os.path.join(output_dir, 'mouth_closed.png'), optimize=True)
+            open_img.save(os.path.join(output_dir, 'mouth_open.png'), optimize=True)
+            manifest["images"] = {"closed": "mouth_closed.png", "open": "mouth_open.png"}
+        
+        with open(os.path.join(output_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, separators=(',', ':'))
         
         if debug_mode:
-            st.write(f"🔍 [DEBUG] 口閉じ画像: {closed_img.size} {closed_img.mode}")
-            st.write(f"🔍 [DEBUG] 口開き画像: {open_img.size} {open_img.mode}")
+            st.write(f"🔍 [DEBUG] マニフェスト出力完了: {len(changes)}個の状態変化, {output_dir}")
         
-        # 画像サイズを統一（大きい方に合わせる）
-        max_width = max(closed_img.width, open_img.width)
-        max_height = max(closed_img.height, open_img.height)
+        return True
+    
+    except Exception as e:
+        if raise_errors:
+            raise
+        st.error(f"マニフェスト生成中にエラーが発生しました: {e}")
+        if debug_mode:
+            import traceback
+            st.error(f"🔍 [DEBUG] 詳細トレースバック:\n{traceback.format_exc()}")
+        return False
+
+def zip_directory(directory):
+    """ディレクトリ内のファイルをZIPにまとめてバイト列で返す"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name in sorted(os.listdir(directory)):
+            zf.write(os.path.join(directory, name), arcname=name)
+    return buffer.getvalue()
+
+def layout_characters(avatar_sizes):
+    """キャラクターを横一列に並べたときのキャンバスサイズと各キャラクターの配置位置を返す"""
+    canvas_width = sum(width for width, _ in avatar_sizes)
+    canvas_height = max(height for _, height in avatar_sizes)
+    
+    positions = []
+    x = 0
+    for width, height in avatar_sizes:
+        # 下揃えで配置
+        positions.append((x, canvas_height - height))
+        x += width
+    
+    return (canvas_width, canvas_height), positions
+
+def compose_scene_frame(avatar_pairs, positions, canvas_size, mouth_state_key):
+    """口の状態の組み合わせ1つ分のフレームをグリーンバック上に合成する"""
+    canvas = Image.new('RGB', canvas_size, (0, 255, 0))
+    for (closed_img, open_img), position, is_open in zip(avatar_pairs, positions, mouth_state_key):
+        frame_img = open_img if is_open else closed_img
+        canvas.paste(frame_img, position, frame_img if frame_img.mode == 'RGBA' else None)
+    return np.array(canvas)
+
+def build_frame_cache(avatar_pairs, positions, canvas_size, frame_keys):
+    """出現する口の状態の組み合わせごとに、合成済みフレームを1回だけ作成する"""
+    frame_cache = {}
+    for key in frame_keys:
+        if key not in frame_cache:
+            frame_cache[key] = compose_scene_frame(avatar_pairs, positions, canvas_size, key)
+    return frame_cache
+
+def file_digest(path):
+    """ファイル内容のSHA-256（画像全体をメモリに展開せずに計算）"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def gop_cache_dir():
+    """エンコード済みセグメントのキャッシュディレクトリ（複数ジョブ・ワーカーで共有）"""
+    return os.environ.get('VTUBER_GOP_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'vtuber_gop_cache'))
+
+def gop_cache_usage():
+    """キャッシュ内のセグメント数と合計サイズ(bytes)を返す"""
+    cache_dir = gop_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return 0, 0
+    sizes = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.h264'):
+            try:
+                sizes.append(entry.stat().st_size)
+            except FileNotFoundError:
+                pass
+    return len(sizes), sum(sizes)
+
+def prune_gop_cache(max_bytes=None):
+    """最後に使われた時刻（ファイルの更新時刻）が古いセグメントから削除し、キャッシュの合計サイズを上限以下にする
+    
+    上限は環境変数 VTUBER_GOP_CACHE_MAX_MB（既定512MB）。削除したセグメント数を返す
+    """
+    if max_bytes is None:
+        max_bytes = int(os.environ.get('VTUBER_GOP_CACHE_MAX_MB', '512')) * 1024 * 1024
+    cache_dir = gop_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return 0
+    
+    segments = []
+    for entry in os.scandir(cache_dir):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        if entry.name.endswith('.h264'):
+            segments.append((stat.st_mtime, stat.st_size, entry.path))
+        elif '.tmp-' in entry.name and time.time() - stat.st_mtime > 3600:
+            # 異常終了したエンコードの書きかけファイル
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+    
+    total_bytes = sum(size for _, size, _ in segments)
+    removed_count = 0
+    for _, size, path in sorted(segments):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        removed_count += 1
+    return removed_count
+
+def plan_gop_segments(frame_keys, block_size, max_repeat=64):
+    """フレーム列を「同じ内容のブロックを2のべき乗回繰り返すセグメント」の列に分割する"""
+    blocks = [tuple(frame_keys[i:i + block_size]) for i in range(0, len(frame_keys), block_size)]
+    segments = []
+    
+    idx = 0
+    while idx < len(blocks):
+        # 同じ内容のブロックが続く範囲を探す
+        run_end = idx
+        while run_end < len(blocks) and blocks[run_end] == blocks[idx]:
+            run_end += 1
+        
+        # 繰り返し回数を2のべき乗に分解（キャッシュの種類を抑えるため）
+        count = run_end - idx
+        while count > 0:
+            repeat = 1
+            while repeat * 2 <= min(count, max_repeat):
+                repeat *= 2
+            segments.append((blocks[idx], repeat))
+            count -= repeat
+        idx = run_end
+    
+    return segments
+
+def gop_encoder_args(keyint):
+    """キャッシュ用セグメントのエンコード設定（全セグメントでSPS/PPSが一致するよう、キーフレーム間隔を含めて固定）"""
+    return [
+        '-c:v', 'libx264', '-preset', 'medium', '-tune', 'stillimage', '-crf', '23', '-pix_fmt', 'yuv420p',
+        '-bf', '0', '-refs', '4', '-g', str(keyint), '-keyint_min', str(keyint), '-sc_threshold', '0',
+        '-f', 'h264'
+    ]
+
+def run_segment_encoder(cmd, output_path, frames=None):
+    """ffmpegでセグメントを一時ファイルにエンコードし、完成後にキャッシュへ配置する"""
+    tmp_path = f"{output_path}.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    process = subprocess.Popen(cmd + [tmp_path], stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    for frame in frames or []:
+        process.stdin.write(frame.tobytes())
+    process.stdin.close()
+    stderr = process.stderr.read()
+    if process.wait() != 0:
+        raise RuntimeError(f"セグメントのエンコードに失敗しました: {stderr.decode(errors='replace')}")
+    
+    # 他のワーカーと同時に書き込んでも壊れないよう、リネームで配置
+    os.replace(tmp_path, output_path)
+
+def rawvideo_h264_command(width, height, fps, keyint, threads=None):
+    """stdinのRGBフレームをH.264（Annex B）にエンコードするffmpegコマンド（出力先は呼び出し側で末尾に付ける）
+    
+    Annex Bにはタイムスタンプがなく、連結時にフレーム番号から振り直すため、Bフレームを使わない固定設定でエンコードする
+    """
+    cmd = [
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-r', str(fps), '-i', 'pipe:0',
+        '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2:color=0x00FF00'
+    ]
+    if threads:
+        cmd += ['-threads', str(threads)]
+    return cmd + gop_encoder_args(keyint)
+
+def encode_gop_segment(frames, fps, keyint, output_path):
+    """フレーム列を、IDRフレームから始まる独立したH.264セグメント（Annex B）としてエンコードする"""
+    height, width = frames[0].shape[:2]
+    run_segment_encoder(rawvideo_h264_command(width, height, fps, keyint), output_path, frames)
+
+def open_frame_ranges(state_changes, total_frames, fps=30):
+    """mouth_state_changesの結果から、口が開いているフレーム区間[(最初, 最後), ...]を返す"""
+    ranges = []
+    for change_idx, (time_ms, state) in enumerate(state_changes):
+        if not state:
+            continue
+        first = round(time_ms * fps / 1000)
+        last = round(state_changes[change_idx + 1][0] * fps / 1000) - 1 if change_idx + 1 < len(state_changes) else total_frames - 1
+        ranges.append((first, last))
+    return ranges
+
+def frame_ranges_expr(ranges, frame_index='n'):
+    """フレーム番号が区間内なら1になるffmpegの式（長い動画でも毎フレームの評価が速いよう、二分探索の形にする）"""
+    if not ranges:
+        return '0'
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        return f"between({frame_index},{first},{last})"
+    middle = len(ranges) // 2
+    return f"if(lt({frame_index},{ranges[middle][0]}),{frame_ranges_expr(ranges[:middle], frame_index)},{frame_ranges_expr(ranges[middle:], frame_index)})"
+
+def scene_filter_graph(character_images, avatar_sizes, positions, canvas_size, fps, open_ranges, frame_index='n'):
+    """元画像から、拡大縮小・合成・偶数サイズへのパディング・yuv420p変換をすべて行うフィルタグラフ（出力は[v]）
+    
+    open_ranges[キャラクター番号]は、frame_indexの式で表したフレーム番号のうち口が開いている区間
+    """
+    canvas_width, canvas_height = canvas_size
+    filters = [f"color=c=0x00FF00:s={canvas_width}x{canvas_height}:r={fps},format=rgb24[bg]"]
+    previous = "bg"
+    for char_idx, (closed_path, open_path) in enumerate(character_images):
+        width, height = avatar_sizes[char_idx]
+        x, y = positions[char_idx]
+        open_expr = frame_ranges_expr(open_ranges[char_idx], frame_index)
+        
+        for state_idx, (image_path, enable_expr) in enumerate([(closed_path, f"not({open_expr})"), (open_path, open_expr)]):
+            label = f"c{char_idx}_{state_idx}"
+            # 拡大縮小は1枚につき1回だけ行い、結果のフレームを繰り返し使う
+            filters.append(
+                f"[{char_idx * 2 + state_idx}:v]scale={width}:{height}:flags=lanczos,format=rgba,"
+                f"loop=loop=-1:size=1:start=0,setpts=N/({fps}*TB)[{label}]"
+            )
+            filters.append(f"[{previous}][{label}]overlay={x}:{y}:format=rgb:enable='{enable_expr}'[o{label}]")
+            previous = f"o{label}"
+    
+    # 色変換はここで1回だけ行う
+    filters.append(f"[{previous}]pad=ceil(iw/2)*2:ceil(ih/2)*2:color=0x00FF00,format=yuv420p[v]")
+    return ';'.join(filters)
+
+def scene_input_args(character_images, filter_graph, work_dir, audio_files=()):
+    """元画像（と音声）の入力とフィルタグラフを指定するffmpeg引数（長いフィルタグラフはコマンドラインの長さ制限を超えないようファイルで渡す）"""
+    cmd = []
+    for image_pair in character_images:
+        for image_path in image_pair:
+            cmd += ['-i', image_path]
+    for audio_file in audio_files:
+        cmd += ['-i', audio_file]
+    if len(filter_graph) <= 8000:
+        return cmd + ['-filter_complex', filter_graph]
+    script_path = os.path.join(work_dir, f"filter-{uuid.uuid4().hex[:8]}.txt")
+    with open(script_path, 'w') as f:
+        f.write(filter_graph)
+    return cmd + ['-filter_complex_script', script_path]
+
+def encode_gop_segment_from_images(character_images, avatar_sizes, positions, canvas_size, content, repeat, fps, keyint, output_path):
+    """元画像から、拡大縮小・合成・偶数サイズへのパディング・yuv420p変換をすべてffmpegのフィルタグラフで行ってセグメントを作る"""
+    block_frames = len(content)
+    # ブロック内の口の開いている区間を、ブロック内の位置(mod(n,ブロック長))で判定する
+    open_ranges = [
+        open_frame_ranges(mouth_state_changes([key[char_idx] for key in content], fps), block_frames, fps)
+        for char_idx in range(len(character_images))
+    ]
+    filter_graph = scene_filter_graph(character_images, avatar_sizes, positions, canvas_size, fps, open_ranges, f"mod(n,{block_frames})")
+    
+    with tempfile.TemporaryDirectory() as work_dir:
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error'] + scene_input_args(character_images, filter_graph, work_dir)
+        cmd += ['-map', '[v]', '-frames:v', str(block_frames * repeat)] + gop_encoder_args(keyint)
+        run_segment_encoder(cmd, output_path)
+
+def encode_scene_chunk(character_images, avatar_sizes, positions, canvas_size, open_ranges, start, end, fps, output_path, work_dir, threads=1):
+    """元画像から、タイムラインのstart〜endフレームをH.264（Annex B）にエンコードする（並列エンコードのチャンク用）"""
+    filter_graph = scene_filter_graph(character_images, avatar_sizes, positions, canvas_size, fps, open_ranges, f"(n+{start})")
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error'] + scene_input_args(character_images, filter_graph, work_dir)
+    # encode_frame_chunkと同じエンコード設定にし、連結後も1本のストリームとして再生できるようにする
+    cmd += ['-map', '[v]', '-frames:v', str(end - start), '-threads', str(threads)] + gop_encoder_args(fps * 10) + [output_path]
+    result = subprocess.run(cmd, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"チャンクのエンコードに失敗しました: {result.stderr.decode(errors='replace')}")
+
+def encode_scene_video(character_images, avatar_sizes, positions, canvas_size, open_ranges, total_frames, fps, audio_files, output_path, work_dir):
+    """元画像から、拡大縮小・合成・エンコード・音声の多重化までを1回のffmpegで行う（タイムライン全体を1本の連続したストリームとしてエンコード）"""
+    filter_graph = scene_filter_graph(character_images, avatar_sizes, positions, canvas_size, fps, open_ranges)
+    audio_filter, audio_map = audio_mix_filter(audio_files, len(character_images) * 2)
+    if audio_filter:
+        filter_graph += ';' + audio_filter
+    
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error'] + scene_input_args(character_images, filter_graph, work_dir, audio_files)
+    cmd += ['-map', '[v]', '-map', audio_map, '-frames:v', str(total_frames)]
+    cmd += [
+        '-c:v', 'libx264', '-preset', 'medium', '-tune', 'stillimage', '-crf', '23', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-shortest', '-movflags', '+faststart', output_path
+    ]
+    result = subprocess.run(cmd, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"動画のエンコードに失敗しました: {result.stderr.decode(errors='replace')}")
+
+def audio_mix_filter(audio_files, first_input):
+    """first_input番目以降の入力の音声を出力するための(フィルタ, -mapの指定)を返す（複数キャラクターの音声はミックス）"""
+    if len(audio_files) == 1:
+        return None, f'{first_input}:a'
+    audio_inputs = ''.join(f'[{idx}:a]' for idx in range(first_input, first_input + len(audio_files)))
+    return f'{audio_inputs}amix=inputs={len(audio_files)}:duration=longest:normalize=0[a]', '[a]'
+
+def mux_video_stream(video_chunks, video_format, fps, audio_files, output_path):
+    """映像ストリームをstdinから受け取り、再エンコードせずに音声と多重化する"""
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-f', video_format, '-framerate', str(fps), '-i', 'pipe:0']
+    for audio_file in audio_files:
+        cmd += ['-i', audio_file]
+    
+    audio_filter, audio_map = audio_mix_filter(audio_files, 1)
+    if audio_filter:
+        cmd += ['-filter_complex', audio_filter]
+    cmd += ['-map', '0:v', '-map', audio_map]
+    # 生のビットストリームにはタイムスタンプがないため、フレーム番号から付け直す
+    cmd += ['-c:v', 'copy', '-bsf:v', f'setts=ts=N/({fps}*TB)', '-c:a', 'aac', '-shortest', '-movflags', '+faststart', output_path]
+    
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        for chunk in video_chunks:
+            process.stdin.write(chunk)
+    except BrokenPipeError:
+        pass  # -shortestで映像の読み込みが先に終わった場合
+    process.stdin.close()
+    stderr = process.stderr.read()
+    if process.wait() != 0:
+        raise RuntimeError(f"音声との多重化に失敗しました: {stderr.decode(errors='replace')}")
+
+def splice_gop_video(frame_keys, frame_digests, encode_segment, fps, audio_files, output_path, frame_switch_interval=3, debug_mode=False, segment_seconds=4.0):
+    """キャッシュ済みのH.264セグメントをビットストリームレベルで連結して動画を作る（映像の再エンコードなし）
+    
+    frame_digestsは口の状態の組み合わせごとのフレーム内容のハッシュ、
+    encode_segment(content, repeat, keyint, output_path)はキャッシュにないセグメントを作る関数
+    """
+    # ブロックは口の開閉周期（口閉じ→口開き）の整数倍にそろえる。
+    # セグメントごとにIDRフレームが入るため、短くするとキャッシュは当たりやすいが出力が大きくなる
+    cycle_frames = frame_switch_interval * 2
+    block_size = cycle_frames * max(1, round(segment_seconds * fps / cycle_frames))
+    max_repeat = 64
+    keyint = block_size * max_repeat
+    
+    cache_dir = gop_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    
+    plan = plan_gop_segments(frame_keys, block_size, max_repeat)
+    
+    # セグメントの内容（合成フレームの並び・繰り返し回数・エンコード設定）でキャッシュを引く
+    segment_data = {}
+    encoded_count = 0
+    for content, repeat in plan:
+        if (content, repeat) in segment_data:
+            continue
+        
+        cache_key = f"v1|{fps}|{keyint}|{repeat}|" + '|'.join(frame_digests[key] for key in content)
+        segment_path = os.path.join(cache_dir, hashlib.sha256(cache_key.encode()).hexdigest() + '.h264')
+        try:
+            with open(segment_path, 'rb') as f:
+                segment_data[(content, repeat)] = f.read()
+            # 使用した時刻を記録し、容量超過時に古いものから削除されるようにする
+            os.utime(segment_path)
+        except FileNotFoundError:
+            # 未作成、または他のジョブが容量超過で削除した直後
+            encode_segment(content, repeat, keyint, segment_path)
+            encoded_count += 1
+            with open(segment_path, 'rb') as f:
+                segment_data[(content, repeat)] = f.read()
+    
+    removed_count = prune_gop_cache()
+    
+    if debug_mode:
+        st.write(f"🔍 [DEBUG] セグメント連結: {len(plan)}個（種類: {len(segment_data)}、新規エンコード: {encoded_count}、容量超過で削除: {removed_count}）")
+    
+    mux_video_stream((segment_data[segment] for segment in plan), 'h264', fps, audio_files, output_path)
+    return True
+
+def find_silent_split_points(voice_timelines, total_frames, chunk_count, fps=30):
+    """動画をほぼ均等なchunk_count個に分ける分割フレームを、全員が無音の位置から選ぶ"""
+    frame_duration = 1.0 / fps
+    
+    def is_silent(frame_idx):
+        segment_index = int(frame_idx * frame_duration * 10)
+        return not any(voice_segments[min(segment_index, len(voice_segments) - 1)] for voice_segments in voice_timelines)
+    
+    chunk_frames = total_frames / chunk_count
+    search_range = int(chunk_frames / 2)
+    split_points = []
+    
+    for chunk_idx in range(1, chunk_count):
+        target = int(chunk_frames * chunk_idx)
+        split_point = target
+        # 理想的な分割位置から近い順に無音フレームを探す（見つからなければそのまま分割）
+        for offset in range(search_range):
+            candidates = [frame_idx for frame_idx in (target - offset, target + offset) if 0 < frame_idx < total_frames]
+            silent = [frame_idx for frame_idx in candidates if is_silent(frame_idx)]
+            if silent:
+                split_point = silent[0]
+                break
+        if split_point > (split_points[-1] if split_points else 0):
+            split_points.append(split_point)
+    
+    return split_points
+
+def encode_frame_chunk(frame_keys, frame_bytes, width, height, fps, output_path, threads=1):
+    """フレーム列を1つのffmpegプロセスでH.264（Annex B）にエンコードする"""
+    # 全チャンクで同じエンコード設定（Bフレームなし・キーフレーム間隔10秒）を使い、連結後も1本のストリームとして再生できるようにする
+    cmd = rawvideo_h264_command(width, height, fps, fps * 10, threads) + [output_path]
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    for key in frame_keys:
+        process.stdin.write(frame_bytes[key])
+    process.stdin.close()
+    stderr = process.stderr.read()
+    if process.wait() != 0:
+        raise RuntimeError(f"チャンクのエンコードに失敗しました: {stderr.decode(errors='replace')}")
+
+def encode_video_parallel(encode_chunk, total_frames, fps, audio_files, output_path, split_points, parallel_workers, debug_mode=False):
+    """分割したチャンクを並列のffmpegプロセスでエンコードし、ストリームコピーで連結して音声と多重化する
+    
+    encode_chunk(start, end, chunk_path, threads)は、start〜endフレームをH.264（Annex B）にエンコードする関数
+    """
+    boundaries = [0] + split_points + [total_frames]
+    chunk_dir = tempfile.mkdtemp(suffix='_chunks')
+    chunk_paths = [os.path.join(chunk_dir, f"chunk_{idx:04d}.h264") for idx in range(len(boundaries) - 1)]
+    
+    # CPUコアをプロセス間で分け合う
+    threads = max(1, (os.cpu_count() or 1) // parallel_workers)
+    
+    if debug_mode:
+        st.write(f"🔍 [DEBUG] 並列エンコード: {len(chunk_paths)}チャンク, {parallel_workers}プロセス × {threads}スレッド, 分割位置: {split_points}")
+    
+    try:
+        # エンコードはffmpegプロセスが行うので、スレッドから各プロセスを起動・待機する
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel_workers) as executor:
+            futures = [
+                executor.submit(encode_chunk, start, end, chunk_path, threads)
+                for start, end, chunk_path in zip(boundaries[:-1], boundaries[1:], chunk_paths)
+            ]
+            for future in futures:
+                future.result()
+        
+        def read_chunks():
+            for chunk_path in chunk_paths:
+                with open(chunk_path, 'rb') as f:
+                    yield f.read()
+        
+        # 音声は全体を1回だけ多重化するため、チャンクの境界で音ずれや途切れが起きない
+        mux_video_stream(read_chunks(), 'h264', fps, audio_files, output_path)
+    finally:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+    
+    return True
+
+def create_mouth_animation_video(audio_file, mouth_closed_img, mouth_open_img, output_path, debug_mode=False, max_image_size=512, voice_threshold=-40, extra_characters=None, use_gop_cache=False, parallel_encoding=False, parallel_workers=None, ffmpeg_scaling=False, max_silence=None, voice_analysis=None, raise_errors=False):
+    """口パク動画を生成する（extra_charactersに(音声, 口閉じ画像, 口開き画像)を渡すと複数キャラクターを並べる）
+    
+    max_silence（秒）を指定すると、全員が無音の区間をその長さまで詰めて出力する。
+    voice_analysisにキャラクターごとのdetect_voice_segmentsの結果を渡すと、音声解析を省略する。
+    raise_errors=Trueの場合（Streamlitの画面がないワーカーなど）は、エラーを表示せず原因を含む例外を送出する
+    """
+    jump_cut_dir = None
+    scaling_dir = None
+    try:
+        characters = [(audio_file, mouth_closed_img, mouth_open_img)] + list(extra_characters or [])
         
         if debug_mode:
-            st.write(f"🔍 [DEBUG] 統一サイズ: {max_width}x{max_height}")
-        
-        # メモリ使用量を抑えるため、画像サイズを制限
-        MAX_DIMENSION = max_image_size  # ユーザーが設定した最大サイズ
-        original_width, original_height = max_width, max_height
-        
-        if max_width > MAX_DIMENSION or max_height > MAX_DIMENSION:
-            # アスペクト比を保持しながらリサイズ
-            ratio = min(MAX_DIMENSION / max_width, MAX_DIMENSION / max_height)
-            new_width = int(max_width * ratio)
-            new_height = int(max_height * ratio)
-            max_width, max_height = new_width, new_height
-            
-            # ユーザーに自動リサイズを通知
-            st.info(f"📏 **画像サイズ自動調整**: {original_width}×{original_height} → {new_width}×{new_height}")
-            st.info(f"💡 メモリ使用量削減のため、アスペクト比を保持したまま{MAX_DIMENSION}px以下にリサイズしました")
+            st.write("🔍 [DEBUG] 動画生成開始")
+            st.write(f"🔍 [DEBUG] 音声ファイル: {[character[0] for character in characters]}")
+            st.write(f"🔍 [DEBUG] 出力パス: {output_path}")
+        
+        # 音声の発音区間をキャラクターごとに検出
+        if debug_mode:
+            st.write("🔍 [DEBUG] 音声解析開始...")
+        
+        voice_timelines = []
+        duration = 0
+        for char_idx, (char_audio, _, _) in enumerate(characters):
+            if voice_analysis is not None:
+                voice_segments, char_duration = voice_analysis[char_idx]
+            elif raise_errors:
+                voice_segments, char_duration = analyze_voice_file(char_audio, voice_threshold)
+            else:
+                voice_segments, char_duration = detect_voice_segments(char_audio, voice_threshold, debug_mode)
             
             if debug_mode:
-                st.write(f"🔍 [DEBUG] 画像サイズを制限: {new_width}x{new_height} (リサイズ比率: {ratio:.2f})")
-        else:
-            st.success(f"✅ **画像サイズ**: {max_width}×{max_height} （{MAX_DIMENSION}px以下のため調整不要）")
+                st.write(f"🔍 [DEBUG] キャラクター{char_idx + 1} 音声解析完了 - 長さ: {char_duration}秒, セグメント数: {len(voice_segments)}")
+            
+            if char_duration == 0:
+                st.error("音声ファイルの長さが取得できませんでした")
+                return False
+            
+            voice_timelines.append(voice_segments)
+            duration = max(duration, char_duration)
         
-        # 画像をリサイズしてRGBに変換（メモリ使用量削減）
-        closed_img = closed_img.resize((max_width, max_height), Image.Resampling.LANCZOS)
-        open_img = open_img.resize((max_width, max_height), Image.Resampling.LANCZOS)
+        # 短い音声のキャラクターは、音声の終了後は口を閉じたままにする
+        segment_count = max(len(voice_segments) for voice_segments in voice_timelines)
+        voice_timelines = [voice_segments + [False] * (segment_count - len(voice_segments)) for voice_segments in voice_timelines]
         
-        # RGBAをRGBに変換してメモリ使用量を25%削減
-        if closed_img.mode == 'RGBA':
-            closed_img = closed_img.convert('RGB')
-        if open_img.mode == 'RGBA':
-            open_img = open_img.convert('RGB')
+        if max_silence is not None:
+            # 長い無音を詰める（音声と映像を同じ区間で切るので、外部の編集ソフトでの再エンコードが不要）
+            kept_ranges = plan_silence_cuts(voice_timelines, round(max_silence * 10))  # 100ms単位のチャンク
+            if not kept_ranges:
+                message = "音声全体が無音と判定されたため、無音を詰めると何も残りません。音声検出感度を下げるか、残す無音の長さを長くしてください"
+                if raise_errors:
+                    raise RuntimeError(message)
+                st.error(message)
+                return False
+            jump_cut_dir = tempfile.mkdtemp(prefix='jump_cut_')
+            original_duration = duration
+            duration = 0
+            cut_characters = []
+            for char_idx, (char_audio, char_closed, char_open) in enumerate(characters):
+                cut_audio_path = os.path.join(jump_cut_dir, f"character{char_idx}.wav")
+                duration = max(duration, cut_audio_file(char_audio, kept_ranges, cut_audio_path, debug_mode=debug_mode))
+                cut_characters.append((cut_audio_path, char_closed, char_open))
+            characters = cut_characters
+            voice_timelines = [
+                [is_speaking for start, end in kept_ranges for is_speaking in voice_segments[start:end]]
+                for voice_segments in voice_timelines
+            ]
             
+            if debug_mode:
+                st.write(f"🔍 [DEBUG] 無音カット: {original_duration:.1f}秒 → {duration:.1f}秒（{len(kept_ranges)}区間を連結）")
+        
+        if ffmpeg_scaling and not check_ffmpeg():
+            st.warning("⚠️ FFmpegが見つからないため、Pythonで画像を縮小して処理します")
+            ffmpeg_scaling = False
+            max_image_size = min(max_image_size, 1024)
+        
+        if ffmpeg_scaling:
+            # 画像はヘッダーからサイズだけを読み、画素の展開・拡大縮小はffmpegに任せる
+            avatar_sizes = []
+            for _, char_closed, char_open in characters:
+                with Image.open(char_closed) as closed_img, Image.open(char_open) as open_img:
+                    avatar_sizes.append(fit_avatar_size([closed_img.size, open_img.size], max_image_size))
+        else:
+            # 画像を読み込み、サイズを統一
+            avatar_pairs = [
+                prepare_avatar_images(char_closed, char_open, max_image_size, debug_mode, keep_alpha=True)
+                for _, char_closed, char_open in characters
+            ]
+            avatar_sizes = [closed_img.size for closed_img, _ in avatar_pairs]
+        canvas_size, positions = layout_characters(avatar_sizes)
+        max_width, max_height = canvas_size
+        
         if debug_mode:
-            st.write(f"🔍 [DEBUG] 最終画像設定: {max_width}x{max_height}, モード: {closed_img.mode}")
+            st.write(f"🔍 [DEBUG] キャンバスサイズ: {max_width}x{max_height}, 配置: {positions}")
         
         # 30fps想定で動画を生成
         fps = 30
@@ -160,139 +861,133 @@ def create_mouth_animation_video(audio_file, mouth_closed_img, mouth_open_img, o
         if debug_mode:
             st.write(f"🔍 [DEBUG] 動画設定: {fps}fps, フレーム時間: {frame_duration:.4f}秒")
         
-        # 長い音声の場合は警告を表示
-        if duration > 120:  # 2分以上
-            st.warning(f"⚠️ 音声が長いです（{duration:.1f}秒）。メモリ不足の可能性があります。2分以下の音声を推奨します。")
-            if duration > 300:  # 5分以上は制限
-                st.error("❌ 音声が長すぎます（5分以上）。処理を中止します。より短い音声をお使いください。")
-                return False
+        # 長い音声の場合は案内を表示（フレームは状態の組み合わせごとに共有するため、メモリ使用量は長さに依存しない）
+        if duration > 120 and not (parallel_encoding or use_gop_cache):  # 2分以上
+            st.warning(f"⚠️ 音声が長いです（{duration:.1f}秒）。エンコードに時間がかかります。詳細設定の並列エンコードを有効にすると短縮できます。")
         
-        # メモリ効率的なフレーム生成（一度に全フレームを保持しない）
+        # キャラクターごとに独立して口の状態を計算
         total_frames = int(duration * fps)
         frame_switch_interval = 3  # 3フレームごとに切り替え
+        mouth_timelines = [
+            build_mouth_timeline(voice_segments, total_frames, fps, frame_switch_interval)
+            for voice_segments in voice_timelines
+        ]
         
-        if debug_mode:
-            st.write(f"🔍 [DEBUG] フレーム生成開始... 総フレーム数: {total_frames}")
-            estimated_memory = (max_width * max_height * 3 * total_frames) / (1024**3)  # GB
-            st.write(f"🔍 [DEBUG] 推定メモリ使用量: {estimated_memory:.2f}GB")
+        # フレームごとの口の状態の組み合わせ（キャラクター数分のタプル）
+        frame_keys = list(zip(*mouth_timelines))
         
-        # 最適化された動画作成：バッチ処理
-        batch_size = 150 if total_frames > 600 else 100  # フレーム数に応じてバッチサイズを調整
-        clips = []
+        if not frame_keys:
+            if raise_errors:
+                raise RuntimeError("フレームの生成に失敗しました")
+            st.error("フレームの生成に失敗しました")
+            return False
         
-        if debug_mode:
-            st.write(f"🔍 [DEBUG] バッチサイズ: {batch_size}フレーム、バッチ数: {(total_frames + batch_size - 1) // batch_size}")
+        audio_files = [character[0] for character in characters]
         
-        # 進行状況表示用
-        progress_text = st.empty()
-        progress_bar_batch = st.progress(0)
-        total_batches = (total_frames + batch_size - 1) // batch_size
+        # 並列エンコードでは、全員が無音の位置で分割する（1チャンクが短すぎると起動コストが勝るため、最低30秒ずつ）
+        split_points = []
+        if parallel_encoding:
+            parallel_workers = parallel_workers or os.cpu_count() or 1
+            chunk_count = min(parallel_workers, total_frames // (30 * fps))
+            if chunk_count >= 2 and check_ffmpeg():
+                split_points = find_silent_split_points(voice_timelines, total_frames, chunk_count, fps)
+            elif debug_mode:
+                st.write("🔍 [DEBUG] 音声が短いかFFmpegがないため、並列エンコードを行わずに出力します")
         
-        for batch_idx, batch_start in enumerate(range(0, total_frames, batch_size)):
-            batch_end = min(batch_start + batch_size, total_frames)
-            batch_frames = []
-            
-            # 進行状況を更新
-            progress_pct = (batch_idx + 1) / total_batches
-            progress_bar_batch.progress(progress_pct)
-            progress_text.text(f"フレーム処理中... {batch_idx + 1}/{total_batches} バッチ ({batch_start}-{batch_end})")
+        if ffmpeg_scaling:
+            # 元画像をffmpegに渡して拡大縮小・合成する（Pythonでは解像度に比例するメモリを使わない）
+            character_images = [(char_closed, char_open) for _, char_closed, char_open in characters]
             
-            if debug_mode:
-                st.write(f"🔍 [DEBUG] バッチ処理中: {batch_start}-{batch_end} ({batch_end - batch_start}フレーム)")
-            
-            for frame_idx in range(batch_start, batch_end):
-                current_time = frame_idx * frame_duration
-                segment_index = min(int(current_time * 10), len(voice_segments) - 1)
-                
-                # 発音区間かどうかチェック
-                is_speaking = segment_index < len(voice_segments) and voice_segments[segment_index]
+            if use_gop_cache:
+                # セグメントを作って連結する
+                image_digests = [(file_digest(char_closed), file_digest(char_open)) for char_closed, char_open in character_images]
+                frame_digests = {
+                    key: f"ffscale|{max_width}x{max_height}|" + '|'.join(
+                        f"{image_digests[char_idx][int(is_open)]}@{avatar_sizes[char_idx]}@{positions[char_idx]}"
+                        for char_idx, is_open in enumerate(key)
+                    )
+                    for key in set(frame_keys)
+                }
                 
-                if debug_mode and frame_idx < batch_start + 5:  # 最初の5フレームをデバッグ
-                    st.write(f"🔍 [DEBUG] フレーム{frame_idx}: 時間{current_time:.2f}s, セグメント{segment_index}, 発音中: {is_speaking}")
+                def encode_segment(content, repeat, keyint, segment_path):
+                    encode_gop_segment_from_images(character_images, avatar_sizes, positions, canvas_size, content, repeat, fps, keyint, segment_path)
                 
-                if is_speaking:
-                    # 発音区間では5フレームごとに口の開閉を切り替え
-                    cycle_position = (frame_idx // frame_switch_interval) % 2
-                    use_open_mouth = cycle_position == 1
-                    frame_img = open_img if use_open_mouth else closed_img
-                    
-                    if debug_mode and frame_idx < batch_start + 5:
-                        st.write(f"🔍 [DEBUG] サイクル位置: {cycle_position}, 口開き: {use_open_mouth}")
-                else:
-                    # 無音区間では口を閉じる
-                    frame_img = closed_img
+                splice_gop_video(frame_keys, frame_digests, encode_segment, fps, audio_files, output_path, frame_switch_interval, debug_mode)
                 
-                batch_frames.append(np.array(frame_img))
+                if debug_mode:
+                    st.write(f"🔍 [DEBUG] 動画出力完了（ffmpegで拡大縮小・セグメント連結: {max_width}x{max_height}）")
+                return True
             
-            if batch_frames:
-                # バッチのフレームを個別のクリップに変換してから結合
-                batch_clips = []
-                for frame in batch_frames:
-                    frame_clip = ImageClip(frame, duration=frame_duration)
-                    batch_clips.append(frame_clip)
-                
-                # バッチ内のクリップを結合
-                if len(batch_clips) == 1:
-                    batch_clip = batch_clips[0]
-                else:
-                    batch_clip = concatenate_videoclips(batch_clips, method="compose")
-                
-                clips.append(batch_clip)
-                
-                # メモリクリーンアップ
-                del batch_frames
-                del batch_clips
+            # 口の開いている区間は、マニフェストと同じくmouth_state_changesから求める
+            open_ranges = [open_frame_ranges(mouth_state_changes(mouth_states, fps), total_frames, fps) for mouth_states in mouth_timelines]
+            scaling_dir = tempfile.mkdtemp(prefix='ffmpeg_scaling_')
+            
+            if split_points:
+                def encode_chunk(start, end, chunk_path, threads):
+                    encode_scene_chunk(character_images, avatar_sizes, positions, canvas_size, open_ranges, start, end, fps, chunk_path, scaling_dir, threads)
                 
-                if debug_mode:
-                    st.write(f"🔍 [DEBUG] バッチクリップ作成完了: バッチ{len(clips)} 処理済み")
-        
-        # プログレスバーをクリーンアップ
-        progress_bar_batch.empty()
-        progress_text.empty()
-        
-        if not clips:
-            st.error("フレームの生成に失敗しました")
-            return False
-        
-        if debug_mode:
-            st.write(f"🔍 [DEBUG] 全バッチ処理完了: {len(clips)}個のバッチクリップを作成")
-        
-        # 背景をグリーンバックに設定（RGB画像では不要だが、念のため定義）
-        green_background = np.full((max_height, max_width, 3), [0, 255, 0], dtype=np.uint8)
+                encode_video_parallel(encode_chunk, total_frames, fps, audio_files, output_path, split_points, len(split_points) + 1, debug_mode)
+            else:
+                # タイムライン全体を1回のffmpegでエンコードする（キーフレームは通常のエンコードと同じ間隔）
+                encode_scene_video(character_images, avatar_sizes, positions, canvas_size, open_ranges, total_frames, fps, audio_files, output_path, scaling_dir)
+            
+            if debug_mode:
+                st.write(f"🔍 [DEBUG] 動画出力完了（ffmpegで拡大縮小: {max_width}x{max_height}）")
+            return True
         
-        if debug_mode:
-            st.write(f"🔍 [DEBUG] グリーンバック背景設定: {max_width}x{max_height}")
+        # 状態の組み合わせごとに1回だけ合成し、全フレームで使い回す
+        frame_cache = build_frame_cache(avatar_pairs, positions, canvas_size, frame_keys)
         
-        # 動画クリップを作成
         if debug_mode:
-            st.write("🔍 [DEBUG] MoviePyクリップ結合開始...")
+            st.write(f"🔍 [DEBUG] 総フレーム数: {total_frames}, 合成フレーム数: {len(frame_cache)}")
+            estimated_memory = (max_width * max_height * 3 * len(frame_cache)) / (1024**2)  # MB
+            st.write(f"🔍 [DEBUG] 推定メモリ使用量: {estimated_memory:.1f}MB")
         
-        try:
-            # バッチで作成されたクリップを結合
-            if debug_mode:
-                st.write(f"🔍 [DEBUG] {len(clips)}個のバッチクリップを結合中...")
+        if use_gop_cache:
+            if check_ffmpeg():
+                # エンコード済みセグメントを連結し、映像のエンコードを省略
+                frame_digests = {key: hashlib.sha256(f"{frame.shape}".encode() + frame.tobytes()).hexdigest() for key, frame in frame_cache.items()}
+                
+                def encode_segment(content, repeat, keyint, segment_path):
+                    encode_gop_segment([frame_cache[key] for key in content] * repeat, fps, keyint, segment_path)
+                
+                splice_gop_video(frame_keys, frame_digests, encode_segment, fps, audio_files, output_path, frame_switch_interval, debug_mode)
+                
+                if debug_mode:
+                    st.write("🔍 [DEBUG] 動画出力完了（セグメント連結）")
+                return True
             
-            video_clip = concatenate_videoclips(clips, method="compose")
-            video_clip = video_clip.set_fps(fps)
+            st.warning("⚠️ FFmpegが見つからないため、セグメントキャッシュを使わずにエンコードします")
+        
+        if split_points:
+            height, width = next(iter(frame_cache.values())).shape[:2]
+            frame_bytes = {key: frame.tobytes() for key, frame in frame_cache.items()}
             
-            if debug_mode:
-                st.write(f"🔍 [DEBUG] 動画クリップ作成完了: {video_clip.duration:.2f}秒")
+            def encode_chunk(start, end, chunk_path, threads):
+                encode_frame_chunk(frame_keys[start:end], frame_bytes, width, height, fps, chunk_path, threads)
             
-        except Exception as clip_error:
-            if debug_mode:
-                st.error(f"🔍 [DEBUG] クリップ結合エラー: {clip_error}")
+            encode_video_parallel(encode_chunk, total_frames, fps, audio_files, output_path, split_points, len(split_points) + 1, debug_mode)
             
-            # フォールバック: 最初のクリップのみ使用
             if debug_mode:
-                st.write("🔍 [DEBUG] フォールバック方法を試行...")
-            
-            video_clip = clips[0] if clips else ImageClip(np.array(closed_img), duration=duration).set_fps(fps)
+                st.write("🔍 [DEBUG] 動画出力完了（並列エンコード）")
+            return True
+        
+        def make_frame(t):
+            frame_idx = min(int(t * fps + 1e-6), total_frames - 1)
+            return frame_cache[frame_keys[frame_idx]]
+        
+        # 動画クリップを作成
+        video_clip = VideoClip(make_frame, duration=total_frames / fps).set_fps(fps)
+        
+        if debug_mode:
+            st.write(f"🔍 [DEBUG] 動画クリップ作成完了: {video_clip.duration:.2f}秒")
         
-        # 音声を追加
+        # 音声を追加（複数キャラクターの場合はミックス）
         if debug_mode:
             st.write("🔍 [DEBUG] 音声クリップ作成中...")
         
-        audio_clip = AudioFileClip(audio_file)
+        audio_clips = [AudioFileClip(char_audio) for char_audio, _, _ in characters]
+        audio_clip = audio_clips[0] if len(audio_clips) == 1 else CompositeAudioClip(audio_clips)
         final_video = video_clip.set_audio(audio_clip)
         
         if debug_mode:
@@ -305,7 +1000,7 @@ def create_mouth_animation_video(audio_file, mouth_closed_img, mouth_open_img, o
             fps=fps,
             audio_codec='aac',
             codec='libx264',
-            temp_audiofile='temp-audio.m4a',
+            temp_audiofile=os.path.splitext(output_path)[0] + '-temp-audio.m4a',  # 複数ワーカー同時実行でも衝突しないよう出力先ごとに分ける
             remove_temp=True,
             verbose=debug_mode,
             logger='bar' if not debug_mode else None
@@ -316,7 +1011,8 @@ def create_mouth_animation_video(audio_file, mouth_closed_img, mouth_open_img, o
         
         # クリップを閉じてメモリを解放
         video_clip.close()
-        audio_clip.close()
+        for clip in audio_clips:
+            clip.close()
         final_video.close()
         
         if debug_mode:
@@ -325,11 +1021,493 @@ def create_mouth_animation_video(audio_file, mouth_closed_img, mouth_open_img, o
         return True
         
     except Exception as e:
+        if raise_errors:
+            raise
         st.error(f"動画生成中にエラーが発生しました: {e}")
         if debug_mode:
             import traceback
             st.error(f"🔍 [DEBUG] 詳細トレースバック:\n{traceback.format_exc()}")
         return False
+    finally:
+        if jump_cut_dir:
+            shutil.rmtree(jump_cut_dir, ignore_errors=True)
+        if scaling_dir:
+            shutil.rmtree(scaling_dir, ignore_errors=True)
+
+def write_file_atomic(path, data):
+    """一時ファイルに書いてからリネームし、途中の状態が他プロセスから見えないようにする"""
+    tmp_path = f"{path}.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def init_spool(spool_dir):
+    """共有スプールのディレクトリ構成を作成する"""
+    for sub_dir in ['jobs', 'pending', 'leases', 'done', 'failed']:
+        os.makedirs(os.path.join(spool_dir, sub_dir), exist_ok=True)
+
+def submit_spool_job(spool_dir, audio_file, mouth_closed_img, mouth_open_img, output_name, max_image_size=512, voice_threshold=-40, extra_characters=None, output_format="mp4", use_sprite_sheet=False, use_gop_cache=False, parallel_encoding=False, ffmpeg_scaling=False, max_silence=None):
+    """入力ファイルを共有スプールにコピーしてレンダリングジョブを投入し、ジョブIDを返す"""
+    init_spool(spool_dir)
+    job_id = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    
+    # 準備中のジョブがワーカーから見えないよう、別名で作成してからリネーム
+    staging_dir = os.path.join(spool_dir, 'jobs', f".staging-{job_id}")
+    os.makedirs(staging_dir)
+    
+    def copy_input(src_path, name):
+        dest_name = name + os.path.splitext(src_path)[1]
+        shutil.copyfile(src_path, os.path.join(staging_dir, dest_name))
+        return dest_name
+    
+    job = {
+        "job_id": job_id,
+        "audio": copy_input(audio_file, "audio"),
+        "mouth_closed": copy_input(mouth_closed_img, "mouth_closed"),
+        "mouth_open": copy_input(mouth_open_img, "mouth_open"),
+        "extra_characters": [
+            [copy_input(char_audio, f"char{idx}_audio"), copy_input(char_closed, f"char{idx}_closed"), copy_input(char_open, f"char{idx}_open")]
+            for idx, (char_audio, char_closed, char_open) in enumerate(extra_characters or [], start=2)
+        ],
+        "output_name": output_name,
+        "output_format": output_format,
+        "use_sprite_sheet": use_sprite_sheet,
+        "use_gop_cache": use_gop_cache,
+        "parallel_encoding": parallel_encoding,
+        "ffmpeg_scaling": ffmpeg_scaling,
+        "max_silence": max_silence,
+        "max_image_size": max_image_size,
+        "voice_threshold": voice_threshold,
+        "submitted_at": time.time(),
+    }
+    write_file_atomic(os.path.join(staging_dir, 'job.json'), json.dumps(job, ensure_ascii=False))
+    
+    os.rename(staging_dir, os.path.join(spool_dir, 'jobs', job_id))
+    write_file_atomic(os.path.join(spool_dir, 'pending', job_id), "")
+    return job_id
+
+def get_spool_job_status(spool_dir, job_id, lease_timeout=60):
+    """スプール上のジョブの状態を返す（pending / running / stale / done / failed）
+    
+    ハートビートがlease_timeoutより長く途絶えているリースは、ワーカーが停止したものとしてstaleを返す
+    """
+    for status in ['done', 'failed']:
+        record_path = os.path.join(spool_dir, status, f"{job_id}.json")
+        if os.path.exists(record_path):
+            with open(record_path, encoding='utf-8') as f:
+                record = json.load(f)
+            record["status"] = status
+            return record
+    
+    lease_path = os.path.join(spool_dir, 'leases', f"{job_id}.lease")
+    try:
+        with open(lease_path, encoding='utf-8') as f:
+            lease = json.load(f)
+        heartbeat_age = time.time() - os.path.getmtime(lease_path)
+        return {"status": "stale" if heartbeat_age > lease_timeout else "running", "worker": lease.get("worker"), "heartbeat_age": heartbeat_age}
+    except (FileNotFoundError, ValueError):
+        pass
+    
+    if os.path.exists(os.path.join(spool_dir, 'pending', job_id)):
+        return {"status": "pending"}
+    return {"status": "unknown"}
+
+def acquire_spool_lease(spool_dir, job_id, worker_id, lease_timeout=60):
+    """ジョブのリースを排他的に取得する。期限切れのリース（ワーカー停止）は奪い取る"""
+    lease_path = os.path.join(spool_dir, 'leases', f"{job_id}.lease")
+    lease = json.dumps({"worker": worker_id, "acquired_at": time.time()})
+    
+    for _ in range(2):
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(lease)
+            return lease_path
+        except FileExistsError:
+            try:
+                heartbeat_age = time.time() - os.path.getmtime(lease_path)
+            except FileNotFoundError:
+                continue
+            if heartbeat_age <= lease_timeout:
+                return None
+            # ハートビートが途絶えたリースを退避（リネームは1つのワーカーだけが成功する）
+            stale_path = f"{lease_path}.stale-{worker_id}"
+            try:
+                os.rename(lease_path, stale_path)
+            except FileNotFoundError:
+                return None
+            if time.time() - os.path.getmtime(stale_path) <= lease_timeout:
+                # 確認後に他のワーカーが取り直した新しいリースだったので元に戻す
+                try:
+                    os.link(stale_path, lease_path)
+                except FileExistsError:
+                    pass
+                os.unlink(stale_path)
+                return None
+            os.unlink(stale_path)
+    return None
+
+def holds_spool_lease(lease_path, worker_id):
+    """リースがまだ自分のものかどうかを確認する"""
+    try:
+        with open(lease_path, encoding='utf-8') as f:
+            return json.load(f).get("worker") == worker_id
+    except (FileNotFoundError, ValueError):
+        return False
+
+def spool_heartbeat(lease_path, stop_event, heartbeat_interval=10):
+    """レンダリング中、リースファイルの更新時刻を定期的に更新する"""
+    while not stop_event.wait(heartbeat_interval):
+        try:
+            os.utime(lease_path)
+        except FileNotFoundError:
+            # 他のワーカーが期限切れを確認するため一時的にリネームしている間は見つからないので、次の周期で再試行する
+            continue
+
+def release_spool_job(spool_dir, job_id, lease_path):
+    """完了したジョブのpendingマーカーとリースを削除する"""
+    for path in [os.path.join(spool_dir, 'pending', job_id), lease_path]:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+def finish_spool_job(spool_dir, job_id, lease_path, status, record):
+    """ジョブの結果をdone/failedに記録してから、ジョブを解放する"""
+    record.update({"job_id": job_id, "finished_at": time.time()})
+    write_file_atomic(os.path.join(spool_dir, status, f"{job_id}.json"), json.dumps(record, ensure_ascii=False))
+    release_spool_job(spool_dir, job_id, lease_path)
+
+def process_spool_job(spool_dir, job_id, worker_id, lease_path, heartbeat_interval=10, max_attempts=3, debug_mode=False):
+    """リースを取得したジョブを1件レンダリングし、出力をスプールに書き戻す"""
+    job_dir = os.path.join(spool_dir, 'jobs', job_id)
+    
+    # 既に他のワーカーが完了させていれば何もしない
+    if os.path.exists(os.path.join(spool_dir, 'done', f"{job_id}.json")):
+        release_spool_job(spool_dir, job_id, lease_path)
+        return True
+    
+    # 試行回数はリース保持中のワーカーだけが更新する
+    # （job.jsonが壊れている・同期途中の場合も試行として数えるよう、ジョブの読み込みより先に更新する）
+    attempts_path = os.path.join(job_dir, 'attempts')
+    attempts = 0
+    try:
+        with open(attempts_path, encoding='utf-8') as f:
+            attempts = int(f.read() or 0)
+    except FileNotFoundError:
+        pass
+    except ValueError:
+        finish_spool_job(spool_dir, job_id, lease_path, 'failed', {"error": "試行回数のファイルが壊れています", "worker": worker_id})
+        return False
+    if attempts >= max_attempts:
+        finish_spool_job(spool_dir, job_id, lease_path, 'failed', {"error": f"{attempts}回試行しましたが完了しませんでした", "attempts": attempts})
+        return False
+    write_file_atomic(attempts_path, str(attempts + 1))
+    
+    stop_event = threading.Event()
+    heartbeat = threading.Thread(target=spool_heartbeat, args=(lease_path, stop_event, heartbeat_interval), daemon=True)
+    heartbeat.start()
+    
+    tmp_output = None
+    try:
+        with open(os.path.join(job_dir, 'job.json'), encoding='utf-8') as f:
+            job = json.load(f)
+        output_path = os.path.join(job_dir, job["output_name"])
+        tmp_output = os.path.join(job_dir, f".rendering-{worker_id}-{job['output_name']}")
+        
+        inputs = [os.path.join(job_dir, job[key]) for key in ['audio', 'mouth_closed', 'mouth_open']]
+        if job["output_format"] == "manifest":
+            manifest_dir = tempfile.mkdtemp(suffix=f'_{job_id}_lipsync')
+            success = export_lipsync_manifest(*inputs, manifest_dir, debug_mode, job["max_image_size"], job["voice_threshold"], job["use_sprite_sheet"], raise_errors=True)
+            if success:
+                with open(tmp_output, 'wb') as f:
+                    f.write(zip_directory(manifest_dir))
+            shutil.rmtree(manifest_dir, ignore_errors=True)
+        else:
+            extra_characters = [tuple(os.path.join(job_dir, name) for name in files) for files in job["extra_characters"]]
+            success = create_mouth_animation_video(
+                *inputs, tmp_output, debug_mode, job["max_image_size"], job["voice_threshold"],
+                extra_characters=extra_characters, use_gop_cache=job.get("use_gop_cache", False),
+                parallel_encoding=job.get("parallel_encoding", False),
+                ffmpeg_scaling=job.get("ffmpeg_scaling", False),
+                max_silence=job.get("max_silence"),
+                raise_errors=True
+            )
+        error = None if success else "レンダリングに失敗しました"
+    except Exception as e:
+        success, error = False, str(e)
+    finally:
+        stop_event.set()
+        heartbeat.join()
+    
+    # リースを奪われていた場合（ハートビート途絶と判定された場合）は結果を捨てる
+    if not holds_spool_lease(lease_path, worker_id):
+        if tmp_output and os.path.exists(tmp_output):
+            os.unlink(tmp_output)
+        return False
+    
+    if success:
+        os.replace(tmp_output, output_path)
+        finish_spool_job(spool_dir, job_id, lease_path, 'done', {"output": job["output_name"], "worker": worker_id, "attempts": attempts + 1})
+        return True
+    
+    if tmp_output and os.path.exists(tmp_output):
+        os.unlink(tmp_output)
+    if attempts + 1 >= max_attempts:
+        finish_spool_job(spool_dir, job_id, lease_path, 'failed', {"error": error, "worker": worker_id, "attempts": attempts + 1})
+    else:
+        # リースを解放して再試行させる
+        os.unlink(lease_path)
+    return False
+
+def run_spool_worker(spool_dir, worker_id=None, poll_interval=2.0, lease_timeout=60, heartbeat_interval=10, max_attempts=3, once=False, debug_mode=False):
+    """共有スプールからジョブを取得してレンダリングするワーカーのメインループ"""
+    init_spool(spool_dir)
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    print(f"🛠️ レンダリングワーカー起動: {worker_id} (スプール: {spool_dir})")
+    
+    while True:
+        claimed = False
+        for job_id in sorted(os.listdir(os.path.join(spool_dir, 'pending'))):
+            if '.tmp-' in job_id:
+                continue
+            lease_path = acquire_spool_lease(spool_dir, job_id, worker_id, lease_timeout)
+            if lease_path is None:
+                continue
+            
+            claimed = True
+            print(f"▶️ ジョブ開始: {job_id}")
+            try:
+                success = process_spool_job(spool_dir, job_id, worker_id, lease_path, heartbeat_interval, max_attempts, debug_mode)
+            except Exception as e:
+                # 1件のジョブの異常でワーカー全体を止めず、失敗として記録して次のジョブへ進む
+                success = False
+                print(f"⚠️ ジョブ処理中にエラーが発生しました: {job_id}: {e}")
+                if holds_spool_lease(lease_path, worker_id):
+                    finish_spool_job(spool_dir, job_id, lease_path, 'failed', {"error": str(e), "worker": worker_id})
+            print(f"{'✅ 完了' if success else '❌ 失敗'}: {job_id}")
+            break
+        
+        if once and not claimed:
+            return
+        if not claimed:
+            time.sleep(poll_interval)
+
+def pcm_dbfs(pcm_bytes):
+    """16bit PCMの音量をdBFSで返す（pydubのAudioSegment.dBFSと同じ定義）"""
+    samples = np.frombuffer(pcm_bytes[:len(pcm_bytes) // 2 * 2], dtype='<i2').astype(np.float64)
+    if samples.size == 0:
+        return float('-inf')
+    rms = np.sqrt(np.mean(samples ** 2))
+    if rms == 0:
+        return float('-inf')
+    return 20 * np.log10(rms / 32768)
+
+def iter_live_mouth_states(pcm_stream, sample_rate=48000, channels=1, fps=30, threshold_silence=-40, lookahead_ms=33, frame_switch_interval=3):
+    """PCMストリームを1フレーム分ずつ読み、先読みを限定した発音判定で口の状態（True=口開き）を順に返す"""
+    frame_size = int(sample_rate / fps) * channels * 2  # 16bit PCM
+    lookahead_frames = max(0, math.ceil(lookahead_ms * fps / 1000))
+    window = collections.deque()
+    frame_idx = 0
+    
+    def decide_state():
+        # 判定窓は現在のフレーム＋先読みフレーム（閾値の意味はdetect_voice_segmentsと同じ）
+        is_speaking = pcm_dbfs(b''.join(window)) > threshold_silence
+        return is_speaking and (frame_idx // frame_switch_interval) % 2 == 1
+    
+    while True:
+        data = pcm_stream.read(frame_size)
+        if not data:
+            break
+        window.append(data)
+        if len(window) > lookahead_frames:
+            yield decide_state()
+            window.popleft()
+            frame_idx += 1
+    
+    # 入力終了時は残りのフレームを出し切る
+    while window:
+        yield decide_state()
+        window.popleft()
+        frame_idx += 1
+
+def open_pcm_source(source):
+    """PCMの入力元を開く（"-"=標準入力, tcp://ホスト:ポート, unix://パス, それ以外=ファイル・名前付きパイプ）"""
+    if source == '-':
+        return sys.stdin.buffer
+    if source.startswith('tcp://'):
+        host, port = source[len('tcp://'):].rsplit(':', 1)
+        connection = socket.create_connection((host, int(port)))
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection.makefile('rb')
+    if source.startswith('unix://'):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(source[len('unix://'):])
+        return connection.makefile('rb')
+    return open(source, 'rb')
+
+def open_frame_sink(sink, width, height, fps):
+    """映像フレームの出力先を開く（"-"=標準出力にrawvideo, URL=ffmpegで低遅延配信, それ以外=ファイル・名前付きパイプ）"""
+    if sink == '-':
+        return sys.stdout.buffer, None
+    if '://' in sink:
+        cmd = [
+            'ffmpeg', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-r', str(fps), '-i', 'pipe:0',
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2:color=0x00FF00',
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency', '-pix_fmt', 'yuv420p', '-g', str(fps),
+            '-f', 'flv' if sink.startswith('rtmp://') else 'mpegts', sink
+        ]
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        return process.stdin, process
+    return open(sink, 'wb'), None
+
+def run_live_lipsync(mouth_closed_img, mouth_open_img, source='-', sink='-', sample_rate=48000, channels=1, voice_threshold=-40, lookahead_ms=33, max_image_size=512):
+    """ストリーミングPCMから口パクフレームをリアルタイムに出力するライブモード"""
+    fps = 30
+    
+    # 口の状態ごとのフレームは起動時に1回だけ合成しておく
+    avatar_pair = prepare_avatar_images(mouth_closed_img, mouth_open_img, max_image_size, keep_alpha=True)
+    canvas_size, positions = layout_characters([avatar_pair[0].size])
+    frame_cache = build_frame_cache([avatar_pair], positions, canvas_size, [(False,), (True,)])
+    frame_bytes = {key[0]: frame.tobytes() for key, frame in frame_cache.items()}
+    width, height = canvas_size
+    
+    lookahead_frames = max(0, math.ceil(lookahead_ms * fps / 1000))
+    print(f"🎙️ ライブモード開始: {width}x{height} rgb24 {fps}fps, 入力 {sample_rate}Hz/{channels}ch s16le", file=sys.stderr)
+    print(f"⏱️ 想定遅延: {(1 + lookahead_frames) * 1000 / fps:.0f}ms（1フレーム + 先読み{lookahead_frames}フレーム）", file=sys.stderr)
+    
+    pcm_stream = open_pcm_source(source)
+    frame_writer, sink_process = open_frame_sink(sink, width, height, fps)
+    frame_count = 0
+    try:
+        for is_open in iter_live_mouth_states(pcm_stream, sample_rate, channels, fps, voice_threshold, lookahead_ms):
+            frame_writer.write(frame_bytes[is_open])
+            frame_writer.flush()
+            frame_count += 1
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
+    finally:
+        for stream in [pcm_stream, frame_writer]:
+            if stream not in (sys.stdin.buffer, sys.stdout.buffer):
+                try:
+                    stream.close()
+                except (BrokenPipeError, OSError):
+                    pass
+        if sink_process is not None:
+            sink_process.wait()
+    
+    print(f"🛑 ライブモード終了: {frame_count}フレーム出力", file=sys.stderr)
+
+def discard_pipeline_item(item):
+    """パイプラインで先読みした項目の一時ファイルを削除する"""
+    if item and item.get("audio_path"):
+        try:
+            os.unlink(item["audio_path"])
+        except FileNotFoundError:
+            pass
+
+def start_pipeline_stage(stage_name, work, input_queue, output_queue, stage_busy, stop_event):
+    """input_queueの項目にworkを適用してoutput_queueへ渡すスレッドを起動する（Noneで終了を次の段に伝える）
+    
+    バックグラウンドのスレッドではStreamlitの表示を呼ばず、失敗は項目の"error"として後段に渡す。
+    stop_eventが設定されたら、処理中の項目の一時ファイルを削除して終了する（キューの空き待ちで止まったままにしない）
+    """
+    def put_until_stopped(item):
+        while not stop_event.is_set():
+            try:
+                output_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        discard_pipeline_item(item)
+        return False
+    
+    def run():
+        while not stop_event.is_set():
+            try:
+                item = input_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is None:
+                put_until_stopped(None)
+                return
+            
+            if not item.get("error"):
+                started = time.perf_counter()
+                try:
+                    item.update(work(item))
+                except Exception as e:
+                    item["error"] = str(e)
+                stage_busy[stage_name] += time.perf_counter() - started
+            if not put_until_stopped(item):
+                return
+    
+    thread = threading.Thread(target=run, name=f"batch-{stage_name}", daemon=True)
+    thread.start()
+    return thread
+
+def iter_batch_pipeline(uploads, analyze=None, stats=None, queue_size=2):
+    """アップロードされた音声を「一時ファイル書き出し→音声解析」のスレッドで先読みし、準備できた順に返す
+    
+    呼び出し側（メインスレッド）が前のファイルをエンコードしている間に、次のファイルの書き出しと解析を進める。
+    キューの長さを制限し、先読みがエンコードより先に進みすぎないようにする。
+    statsには各段の稼働時間（秒）と全体の経過時間"wall"が入る。
+    途中で打ち切られた場合（close()やStreamlitの再実行）は、スレッドを止めて未処理の一時ファイルを削除する
+    """
+    stats = stats if stats is not None else {}
+    stats.update({"write": 0.0, "analysis": 0.0, "encode": 0.0, "wall": 0.0})
+    started = time.perf_counter()
+    
+    def write_audio(item):
+        file_extension = '.wav' if item["upload"].name.endswith('.wav') else '.mp3'
+        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as tmp_audio:
+            tmp_audio.write(item["upload"].read())
+        return {"audio_path": tmp_audio.name}
+    
+    def analyze_audio(item):
+        return {"voice_analysis": analyze(item["audio_path"]) if analyze else None}
+    
+    upload_queue = queue.Queue()
+    for file_idx, upload in enumerate(uploads):
+        upload_queue.put({"index": file_idx, "upload": upload})
+    upload_queue.put(None)
+    
+    stop_event = threading.Event()
+    written_queue = queue.Queue(maxsize=queue_size)
+    analyzed_queue = queue.Queue(maxsize=queue_size)
+    stage_threads = [
+        start_pipeline_stage("write", write_audio, upload_queue, written_queue, stats, stop_event),
+        start_pipeline_stage("analysis", analyze_audio, written_queue, analyzed_queue, stats, stop_event),
+    ]
+    
+    handed_item = None
+    try:
+        while True:
+            item = analyzed_queue.get()
+            if item is None:
+                break
+            
+            # 呼び出し側に制御が戻るまでの時間をエンコード段の稼働時間とする
+            handed_off = time.perf_counter()
+            handed_item = item
+            yield item
+            handed_item = None
+            stats["encode"] += time.perf_counter() - handed_off
+        
+        stats["wall"] = time.perf_counter() - started
+    finally:
+        # 打ち切られた場合、呼び出し側が処理しきれなかった項目と先読み済みの項目の一時ファイルを削除する
+        stop_event.set()
+        discard_pipeline_item(handed_item)
+        for thread in stage_threads:
+            thread.join()
+        for pending_queue in [written_queue, analyzed_queue]:
+            while True:
+                try:
+                    discard_pipeline_item(pending_queue.get_nowait())
+                except queue.Empty:
+                    break
 
 def check_ffmpeg():
     """FFmpegがインストールされているかチェック"""
@@ -365,13 +1543,18 @@ def main():
     
     # 詳細設定
     with st.expander("⚙️ 詳細設定"):
+        ffmpeg_scaling = st.checkbox(
+            "🖥️ 拡大縮小をFFmpegで行う（1080p/4K出力）",
+            value=False,
+            help="元画像をそのままFFmpegに渡し、拡大縮小・偶数サイズへの調整・yuv420p変換をFFmpeg内で1回だけ行います。Pythonが高解像度のフレームを保持しないため、解像度を上げてもメモリ使用量が増えません。セグメントキャッシュ・並列エンコードの設定はこのモードでも有効です。FFmpegが必要です"
+        )
         max_image_size = st.slider(
             "最大画像サイズ (px)", 
             min_value=256, 
-            max_value=1024, 
+            max_value=3840 if ffmpeg_scaling else 1024, 
             value=512, 
             step=64,
-            help="画像の最大サイズを設定します。大きいほど高画質ですが、メモリを多く使用します"
+            help="画像の最大サイズを設定します。大きいほど高画質ですが、メモリを多く使用します（FFmpegで拡大縮小する場合を除く）"
         )
         st.write(f"選択されたサイズ: {max_image_size}×{max_image_size}px以下に自動調整されます")
         
@@ -386,6 +1569,64 @@ def main():
             help="値が大きいほど検出感度が高くなります。-40が推奨値です"
         )
         st.write(f"設定値: {voice_threshold}dBFS（小さい音も検出: {voice_threshold > -45}）")
+        
+        use_jump_cut = st.checkbox(
+            "✂️ 長い無音を詰める（ジャンプカット）",
+            value=False,
+            help="音声解析で検出した無音区間のうち、指定した長さより長いものを詰めて、音声と動画を同時にカットします。出力が短くなる分エンコードも速くなります（MP4出力のみ）"
+        )
+        max_silence = None
+        if use_jump_cut:
+            max_silence = st.slider(
+                "残す無音の長さ (秒)",
+                min_value=0.0,
+                max_value=2.0,
+                value=0.5,
+                step=0.1,
+                help="これより長い無音は、この長さまで短縮されます（前後に半分ずつ残します）。0にすると無音を完全に取り除きます"
+            )
+        
+        st.divider()
+        
+        output_format = st.radio(
+            "出力形式",
+            ["MP4動画", "タイミングマニフェスト（JSON + 画像）"],
+            help="マニフェストでは動画をエンコードせず、口の開閉タイミング(ms)と画像だけを書き出します。Webオーバーレイ側で画像を切り替えて再生する場合に使用します"
+        )
+        use_sprite_sheet = False
+        if output_format != "MP4動画":
+            use_sprite_sheet = st.checkbox("画像を1枚のスプライトシートにまとめる", value=False)
+        
+        st.divider()
+        
+        use_gop_cache = st.checkbox(
+            "🎞️ エンコード済みセグメントを再利用する（高速化）",
+            value=False,
+            help="口パクの数秒分ごとにH.264セグメントを1度だけエンコードしてキャッシュし、同じアバター・同じ口の動きの部分は連結するだけで動画を作成します。セグメントごとにキーフレームが入るため、出力ファイルは通常のエンコードの2倍程度の大きさになります。FFmpegが必要です"
+        )
+        if use_gop_cache:
+            cache_count, cache_bytes = gop_cache_usage()
+            st.write(f"キャッシュ: {cache_count}個, {cache_bytes / (1024 * 1024):.1f}MB（上限 {os.environ.get('VTUBER_GOP_CACHE_MAX_MB', '512')}MB、古いものから自動削除）")
+            if st.button("🗑️ セグメントキャッシュを削除", disabled=cache_count == 0):
+                prune_gop_cache(0)
+                st.rerun()
+        
+        parallel_encoding = st.checkbox(
+            "⚡ 長い音声を分割して並列エンコードする",
+            value=False,
+            help="無音の位置で動画を分割し、CPUコア数分のプロセスで同時にエンコードしてから無劣化で連結します。1分未満の音声では通常どおり処理します。セグメントキャッシュを使う場合は、キャッシュの連結が優先されるため適用されません。FFmpegが必要です"
+        )
+        
+        st.divider()
+        
+        use_spool = st.checkbox(
+            "共有スプールに投入して分散ワーカーで処理する",
+            value=False,
+            help="`python app.py --worker --spool <ディレクトリ>` で起動したワーカーが、共有ディレクトリ（NFSなど）からジョブを取得してレンダリングします"
+        )
+        spool_dir = os.environ.get('VTUBER_SPOOL_DIR', 'render_spool')
+        if use_spool:
+            spool_dir = st.text_input("スプールディレクトリ", value=spool_dir)
     
     # セッション状態の初期化
     if 'generated_video' not in st.session_state:
@@ -412,13 +1653,14 @@ def main():
     # 処理モードの選択
     processing_mode = st.radio(
         "処理モードを選択してください",
-        ["シングルモード（1つずつ処理）", "バッチモード（複数を自動処理）"],
-        help="バッチモードでは複数の音声ファイルを一度にアップロードして自動処理できます"
+        ["シングルモード（1つずつ処理）", "バッチモード（複数を自動処理）", "マルチキャラクターモード（2〜3人の掛け合い）"],
+        help="バッチモードでは複数の音声ファイルを一度にアップロードして自動処理できます。マルチキャラクターモードでは、キャラクターごとの音声で口パクする複数のアバターを1つの動画に並べます"
     )
+    is_multi_character = processing_mode == "マルチキャラクターモード（2〜3人の掛け合い）"
     
     # 音声ファイルのアップロード
-    st.subheader("1. 音声ファイル (.wav/.mp3)")
-    if processing_mode == "シングルモード（1つずつ処理）":
+    st.subheader("1. 音声ファイル (.wav/.mp3)" if not is_multi_character else "1. キャラクター1の音声ファイル (.wav/.mp3)")
+    if processing_mode == "シングルモード（1つずつ処理）" or is_multi_character:
         audio_files = st.file_uploader(
             "音声ファイルを選択してください",
             type=['wav', 'mp3'],
@@ -548,6 +1790,37 @@ def main():
             else:
                 st.image(mouth_open, caption="口開き画像", width=200)
     
+    # 追加キャラクターのアップロード（マルチキャラクターモードのみ）
+    extra_character_files = []
+    if is_multi_character:
+        st.subheader("4. 追加キャラクター")
+        extra_count = st.number_input("追加するキャラクター数", min_value=1, max_value=2, value=1, step=1)
+        
+        for char_idx in range(2, int(extra_count) + 2):
+            st.markdown(f"**キャラクター{char_idx}**")
+            char_audio = st.file_uploader(
+                f"キャラクター{char_idx}の音声ファイル",
+                type=['wav', 'mp3'],
+                key=f"char_audio_{char_idx}"
+            )
+            col1, col2 = st.columns(2)
+            with col1:
+                char_closed = st.file_uploader(
+                    f"キャラクター{char_idx}の口閉じ画像",
+                    type=['png', 'jpg', 'jpeg'],
+                    key=f"char_closed_{char_idx}"
+                )
+            with col2:
+                char_open = st.file_uploader(
+                    f"キャラクター{char_idx}の口開き画像",
+                    type=['png', 'jpg', 'jpeg'],
+                    key=f"char_open_{char_idx}"
+                )
+            extra_character_files.append((char_audio, char_closed, char_open))
+        
+        st.info("💡 キャラクターは左から順に横並びで配置され、各音声はミックスされます")
+    extra_characters_ready = all(all(files) for files in extra_character_files)
+    
     # 動画生成ボタン
     st.header("🎬 動画生成")
     
@@ -556,8 +1829,18 @@ def main():
     
     # ボタンのラベルを処理モードに応じて変更
     audio_count = len(audio_files) if audio_files else 0
-    button_label = "動画を生成する" if processing_mode == "シングルモード（1つずつ処理）" else f"バッチ処理を開始する（{audio_count}個のファイル）"
-    button_disabled = not (audio_files and len([f for f in audio_files if f is not None]) > 0 and mouth_closed and mouth_open)
+    is_manifest_output = output_format != "MP4動画"
+    if is_multi_character and is_manifest_output:
+        st.warning("⚠️ マルチキャラクターモードではタイミングマニフェストに対応していないため、MP4動画を出力します")
+        is_manifest_output = False
+    
+    if is_multi_character:
+        button_label = "掛け合い動画を生成する"
+    elif processing_mode == "シングルモード（1つずつ処理）":
+        button_label = "マニフェストを生成する" if is_manifest_output else "動画を生成する"
+    else:
+        button_label = f"バッチ処理を開始する（{audio_count}個のファイル）"
+    button_disabled = not (audio_files and len([f for f in audio_files if f is not None]) > 0 and mouth_closed and mouth_open and extra_characters_ready)
     
     if st.button(button_label, type="primary", disabled=button_disabled):
         if audio_files and mouth_closed and mouth_open and len([f for f in audio_files if f is not None]) > 0:
@@ -575,11 +1858,15 @@ def main():
             if 'batch_video_names' not in st.session_state:
                 st.session_state.batch_video_names = []
             
+            if 'spool_jobs' not in st.session_state:
+                st.session_state.spool_jobs = []
+            
             # バッチ処理開始時にクリア
             if is_batch_mode:
                 st.session_state.batch_videos = []
                 st.session_state.batch_video_names = []
             
+            batch_pipeline = None
             try:
                 if is_batch_mode:
                     st.subheader(f"🚀 バッチ処理開始（{len(valid_audio_files)}個のファイル）")
@@ -593,11 +1880,34 @@ def main():
                     tmp_open.write(mouth_open.read())
                     tmp_open_path = tmp_open.name
                 
+                # 追加キャラクターの一時ファイルを作成
+                extra_characters = []
+                for char_audio, char_closed, char_open in extra_character_files:
+                    char_paths = []
+                    for upload, suffix in [(char_audio, '.wav' if char_audio.name.endswith('.wav') else '.mp3'), (char_closed, '.png'), (char_open, '.png')]:
+                        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_char:
+                            tmp_char.write(upload.read())
+                            char_paths.append(tmp_char.name)
+                    extra_characters.append(tuple(char_paths))
+                
                 successful_videos = 0
                 failed_videos = 0
                 
-                # 各音声ファイルを処理
-                for file_idx, audio_file in enumerate(valid_audio_files):
+                # 動画を作る場合は、音声解析を書き出しの後段のスレッドで行う（追加キャラクターの音声は全ファイル共通なので先に1回だけ解析）
+                def analyze_batch_audio(audio_path):
+                    # スレッド内ではStreamlitを呼べないため、例外で失敗の原因をメインスレッドに渡す
+                    return [analyze_voice_file(audio_path, voice_threshold)] + extra_analysis
+                
+                analyze = None
+                if not (use_spool or is_manifest_output):
+                    extra_analysis = [detect_voice_segments(char_audio, voice_threshold, debug_mode) for char_audio, _, _ in extra_characters]
+                    analyze = analyze_batch_audio
+                
+                # 各音声ファイルを処理（次のファイルの書き出し・音声解析は、前のファイルのエンコード中に別スレッドで進める）
+                batch_stats = {}
+                batch_pipeline = iter_batch_pipeline(valid_audio_files, analyze, batch_stats)
+                for batch_item in batch_pipeline:
+                    file_idx, audio_file = batch_item["index"], batch_item["upload"]
                     if debug_mode:
                         st.write(f"🔍 [DEBUG] ファイル {file_idx + 1}/{len(valid_audio_files)}: {audio_file.name}")
                     
@@ -619,50 +1929,98 @@ def main():
                         file_status.text(f"音声ファイル処理中: {audio_file.name}")
                         file_progress.progress(25)
                         
-                        # 音声ファイルの一時ファイルを作成
-                        file_extension = '.wav' if audio_file.name.endswith('.wav') else '.mp3'
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as tmp_audio:
-                            tmp_audio.write(audio_file.read())
-                            tmp_audio_path = tmp_audio.name
+                        # 音声ファイルの一時ファイル（書き出しスレッドで作成済み）
+                        if batch_item.get("error"):
+                            if batch_item.get("audio_path"):
+                                os.unlink(batch_item["audio_path"])
+                            raise RuntimeError(f"音声ファイルの処理中にエラーが発生しました: {batch_item['error']}")
+                        tmp_audio_path = batch_item["audio_path"]
+                        
+                        if debug_mode and batch_item.get("voice_analysis"):
+                            voice_segments, char_duration = batch_item["voice_analysis"][0]
+                            speaking_chunks = sum(voice_segments)
+                            st.write(f"🔍 [DEBUG] 音声解析完了（バックグラウンド） - 長さ: {char_duration}秒, {len(voice_segments)}個のチャンク, 発音区間: {speaking_chunks}/{len(voice_segments)}, 閾値: {voice_threshold}dBFS")
                         
                         if debug_mode:
                             st.write(f"🔍 [DEBUG] 一時ファイル作成: {tmp_audio_path}")
                         
-                        file_progress.progress(50)
-                        file_status.text(f"音声解析中: {audio_file.name}")
-                        
                         # 出力ファイルパス（ファイル名に基づいて生成）
                         base_name = os.path.splitext(audio_file.name)[0]
-                        output_path = tempfile.mktemp(suffix=f'_{base_name}.mp4')
                         
-                        file_progress.progress(75)
-                        file_status.text(f"動画作成中: {audio_file.name}")
+                        if use_spool:
+                            # 共有スプールにジョブを投入（レンダリングはワーカーが行う）
+                            output_name = f"{base_name}_lipsync.zip" if is_manifest_output else f"{base_name}.mp4"
+                            job_id = submit_spool_job(
+                                spool_dir, tmp_audio_path, tmp_closed_path, tmp_open_path, output_name, max_image_size, voice_threshold,
+                                extra_characters=extra_characters,
+                                output_format="manifest" if is_manifest_output else "mp4",
+                                use_sprite_sheet=use_sprite_sheet,
+                                use_gop_cache=use_gop_cache,
+                                parallel_encoding=parallel_encoding,
+                                ffmpeg_scaling=ffmpeg_scaling,
+                                max_silence=max_silence
+                            )
+                            st.session_state.spool_jobs.append({"job_id": job_id, "spool_dir": spool_dir, "output_name": output_name})
+                            
+                            file_progress.progress(100)
+                            file_status.text(f"📡 投入完了: {audio_file.name} (ジョブID: {job_id})")
+                            successful_videos += 1
+                            
+                            os.unlink(tmp_audio_path)
+                            continue
+                        
+                        file_progress.progress(50)
+                        file_status.text(f"音声解析中: {audio_file.name}")
                         
-                        # 動画生成
-                        success = create_mouth_animation_video(
-                            tmp_audio_path, tmp_closed_path, tmp_open_path, output_path, debug_mode, max_image_size, voice_threshold
-                        )
+                        if is_manifest_output:
+                            output_path = tempfile.mkdtemp(suffix=f'_{base_name}_lipsync')
+                            output_name = f"{base_name}_lipsync.zip"
+                            
+                            file_progress.progress(75)
+                            file_status.text(f"マニフェスト作成中: {audio_file.name}")
+                            
+                            # マニフェスト生成（動画エンコードなし）
+                            success = export_lipsync_manifest(
+                                tmp_audio_path, tmp_closed_path, tmp_open_path, output_path, debug_mode, max_image_size, voice_threshold, use_sprite_sheet
+                            )
+                        else:
+                            output_path = tempfile.mktemp(suffix=f'_{base_name}.mp4')
+                            output_name = f"{base_name}.mp4"
+                            
+                            file_progress.progress(75)
+                            file_status.text(f"動画作成中: {audio_file.name}")
+                            
+                            # 動画生成
+                            success = create_mouth_animation_video(
+                                tmp_audio_path, tmp_closed_path, tmp_open_path, output_path, debug_mode, max_image_size, voice_threshold,
+                                extra_characters=extra_characters, use_gop_cache=use_gop_cache, parallel_encoding=parallel_encoding,
+                                ffmpeg_scaling=ffmpeg_scaling, max_silence=max_silence, voice_analysis=batch_item["voice_analysis"]
+                            )
                         
                         if success:
                             file_progress.progress(100)
                             file_status.text(f"✅ 完了: {audio_file.name}")
                             
-                            # 生成された動画を読み込み
-                            with open(output_path, 'rb') as f:
-                                video_data = f.read()
+                            # 生成されたファイルを読み込み
+                            if is_manifest_output:
+                                video_data = zip_directory(output_path)
+                            else:
+                                with open(output_path, 'rb') as f:
+                                    video_data = f.read()
                             
                             if is_batch_mode:
                                 # バッチモードでは配列に追加
                                 st.session_state.batch_videos.append(video_data)
-                                st.session_state.batch_video_names.append(f"{base_name}.mp4")
+                                st.session_state.batch_video_names.append(output_name)
                                 
                                 # ファイルサイズ表示
                                 file_size = len(video_data) / (1024 * 1024)
-                                st.success(f"✅ 生成完了: {base_name}.mp4 ({file_size:.1f}MB)")
+                                st.success(f"✅ 生成完了: {output_name} ({file_size:.1f}MB)")
                             else:
                                 # シングルモードでは従来通り
                                 st.session_state.generated_video = video_data
                                 st.session_state.video_path = output_path
+                                st.session_state.generated_video_name = "vtuber_lipsync.zip" if is_manifest_output else "vtuber_animation.mp4"
                             
                             successful_videos += 1
                             
@@ -682,22 +2040,44 @@ def main():
                     except Exception as file_error:
                         file_progress.progress(0)
                         file_status.text(f"❌ エラー: {audio_file.name}")
-                        if is_batch_mode:
-                            st.error(f"❌ {audio_file.name} でエラー: {file_error}")
+                        st.error(f"❌ {audio_file.name} でエラー: {file_error}")
                         failed_videos += 1
                 
                 # 全体の処理完了
                 progress_bar.progress(100)
                 
-                if is_batch_mode:
+                if use_spool:
+                    status_text.text("📡 スプールへの投入完了！")
+                    st.success(f"📡 {successful_videos}個のジョブを共有スプールに投入しました。下記のスプールジョブ欄で進行状況を確認できます。")
+                elif is_batch_mode:
                     status_text.text("🎉 バッチ処理完了！")
                     st.success(f"🎉 バッチ処理完了！ 成功: {successful_videos}個, 失敗: {failed_videos}個")
                     
+                    # 段ごとの稼働率（稼働時間 / 全体の経過時間）。最も高い段がボトルネック
+                    if batch_stats.get("wall"):
+                        stage_labels = {"write": "一時ファイル書き出し", "analysis": "音声解析", "encode": "動画作成"}
+                        st.write("⏱️ 処理段ごとの稼働率")
+                        stage_columns = st.columns(len(stage_labels))
+                        for column, (stage_name, stage_label) in zip(stage_columns, stage_labels.items()):
+                            utilization = batch_stats[stage_name] / batch_stats["wall"] * 100
+                            column.metric(stage_label, f"{utilization:.0f}%", f"{batch_stats[stage_name]:.1f}秒", delta_color="off")
+                        bottleneck = max(stage_labels, key=lambda stage_name: batch_stats[stage_name])
+                        st.info(f"💡 ボトルネック: {stage_labels[bottleneck]}（全体 {batch_stats['wall']:.1f}秒）")
+                    
                     if successful_videos > 0:
                         st.info(f"📹 {successful_videos}個の動画が生成されました。下記のダウンロードセクションから個別にダウンロードできます。")
                 else:
                     # シングルモードの場合のプレビュー表示
-                    if successful_videos > 0:
+                    if successful_videos > 0 and is_manifest_output:
+                        status_text.text("マニフェスト生成完了！")
+                        st.success("✅ タイミングマニフェストが正常に生成されました！")
+                        
+                        st.subheader("📋 マニフェスト")
+                        with open(os.path.join(st.session_state.video_path, 'manifest.json'), encoding='utf-8') as f:
+                            st.json(json.load(f), expanded=False)
+                        file_size = len(st.session_state.generated_video) / 1024
+                        st.info(f"📊 **出力情報**: ZIPサイズ {file_size:.1f}KB")
+                    elif successful_videos > 0:
                         status_text.text("動画生成完了！")
                         st.success("✅ 動画が正常に生成されました！")
                         
@@ -719,7 +2099,7 @@ def main():
                             st.info("💡 動画は正常に生成されました。ダウンロードしてご確認ください。")
                 
                 # 口画像の一時ファイルをクリーンアップ
-                for temp_file in [tmp_closed_path, tmp_open_path]:
+                for temp_file in [tmp_closed_path, tmp_open_path] + [path for paths in extra_characters for path in paths]:
                     try:
                         os.unlink(temp_file)
                     except:
@@ -732,9 +2112,57 @@ def main():
                 if debug_mode:
                     import traceback
                     st.error(f"🔍 [DEBUG] トレースバック:\n{traceback.format_exc()}")
+            finally:
+                # 再実行・停止で途中終了した場合も、先読み用のスレッドと一時ファイルを片付ける
+                if batch_pipeline is not None:
+                    batch_pipeline.close()
         else:
             st.warning("⚠️ すべてのファイルをアップロードしてください。")
     
+    # 共有スプールに投入したジョブの状態
+    if st.session_state.get('spool_jobs'):
+        st.header("📡 スプールジョブ")
+        
+        auto_refresh = st.checkbox("自動更新（3秒ごと）", value=False)
+        if st.button("🔄 状態を更新"):
+            st.rerun()
+        
+        status_labels = {"pending": "⏳ 待機中", "running": "⚙️ 処理中", "stale": "⚠️ 応答なし", "done": "✅ 完了", "failed": "❌ 失敗", "unknown": "❓ 不明"}
+        has_unfinished_jobs = False
+        for job in st.session_state.spool_jobs:
+            job_status = get_spool_job_status(job["spool_dir"], job["job_id"])
+            has_unfinished_jobs = has_unfinished_jobs or job_status["status"] in ["pending", "running", "stale"]
+            
+            col1, col2 = st.columns([3, 1])
+            with col1:
+                detail = ""
+                if job_status["status"] == "running":
+                    detail = f"（ワーカー: {job_status['worker']}）"
+                elif job_status["status"] == "stale":
+                    detail = f"（ワーカー {job_status['worker']} から{job_status['heartbeat_age']:.0f}秒応答がありません。他のワーカーが再試行します）"
+                elif job_status["status"] == "failed":
+                    detail = f"（{job_status.get('error')}）"
+                st.write(f"{status_labels[job_status['status']]} **{job['output_name']}** `{job['job_id']}` {detail}")
+            with col2:
+                if job_status["status"] == "done":
+                    with open(os.path.join(job["spool_dir"], 'jobs', job["job_id"], job_status["output"]), 'rb') as f:
+                        st.download_button(
+                            label="📥",
+                            data=f.read(),
+                            file_name=job["output_name"],
+                            mime="application/zip" if job["output_name"].endswith('.zip') else "video/mp4",
+                            key=f"spool_download_{job['job_id']}",
+                            use_container_width=True
+                        )
+        
+        if st.button("🗑️ ジョブ一覧をクリア", type="secondary"):
+            st.session_state.spool_jobs = []
+            st.rerun()
+        
+        if auto_refresh and has_unfinished_jobs:
+            time.sleep(3)
+            st.rerun()
+    
     # ダウンロードセクション
     has_single_video = 'generated_video' in st.session_state and st.session_state.generated_video is not None
     has_batch_videos = 'batch_videos' in st.session_state and len(st.session_state.batch_videos) > 0
@@ -748,11 +2176,13 @@ def main():
             
             with col1:
                 if st.session_state.generated_video is not None:
+                    file_name = st.session_state.get('generated_video_name', "vtuber_animation.mp4")
+                    is_zip = file_name.endswith('.zip')
                     st.download_button(
-                        label="🎬 動画をダウンロード (.mp4)",
+                        label="📦 マニフェストをダウンロード (.zip)" if is_zip else "🎬 動画をダウンロード (.mp4)",
                         data=st.session_state.generated_video,
-                        file_name="vtuber_animation.mp4",
-                        mime="video/mp4",
+                        file_name=file_name,
+                        mime="application/zip" if is_zip else "video/mp4",
                         use_container_width=True
                     )
                 else:
@@ -763,7 +2193,10 @@ def main():
                     # 一時ファイルも削除
                     if 'video_path' in st.session_state and os.path.exists(st.session_state.video_path):
                         try:
-                            os.unlink(st.session_state.video_path)
+                            if os.path.isdir(st.session_state.video_path):
+                                shutil.rmtree(st.session_state.video_path)
+                            else:
+                                os.unlink(st.session_state.video_path)
                         except:
                             pass
                     
@@ -791,7 +2224,7 @@ def main():
                         label=f"📹 {file_name} ({file_size:.1f}MB)",
                         data=video_data,
                         file_name=file_name,
-                        mime="video/mp4",
+                        mime="application/zip" if file_name.endswith('.zip') else "video/mp4",
                         key=f"download_{idx}",
                         use_container_width=True
                     )
@@ -815,5 +2248,42 @@ def main():
                     st.session_state.batch_video_names = []
                     st.rerun()
 
+def parse_cli_args(argv):
+    """コマンドライン引数を解析する（Streamlitから起動された場合は引数なし）"""
+    import argparse
+    parser = argparse.ArgumentParser(description="喋る風Vtuber動画ジェネレーター")
+    parser.add_argument('--worker', action='store_true', help="共有スプールのレンダリングワーカーとして起動する")
+    parser.add_argument('--spool', default=os.environ.get('VTUBER_SPOOL_DIR', 'render_spool'), help="共有スプールのディレクトリ（NFSなど）")
+    parser.add_argument('--worker-id', default=None, help="ワーカーID（省略時はホスト名-PID）")
+    parser.add_argument('--poll-interval', type=float, default=2.0, help="ジョブがないときの待機秒数")
+    parser.add_argument('--lease-timeout', type=float, default=60, help="ハートビートが途絶えたリースを奪うまでの秒数")
+    parser.add_argument('--heartbeat-interval', type=float, default=10, help="ハートビートの間隔（秒）")
+    parser.add_argument('--max-attempts', type=int, default=3, help="1ジョブあたりの最大試行回数")
+    parser.add_argument('--once', action='store_true', help="処理できるジョブがなくなったら終了する")
+    parser.add_argument('--debug', action='store_true', help="デバッグ情報を出力する")
+    parser.add_argument('--live', action='store_true', help="ストリーミングPCMから口パクフレームを出力するライブモードで起動する")
+    parser.add_argument('--source', default='-', help="PCM入力元（-=標準入力, tcp://ホスト:ポート, unix://パス, 名前付きパイプ）")
+    parser.add_argument('--sink', default='-', help="フレーム出力先（-=標準出力にrawvideo, udp://やrtmp://などのURL, 名前付きパイプ）")
+    parser.add_argument('--sample-rate', type=int, default=48000, help="入力PCMのサンプルレート（s16le）")
+    parser.add_argument('--channels', type=int, default=1, help="入力PCMのチャンネル数")
+    parser.add_argument('--threshold', type=int, default=-40, help="音声検出の閾値（dBFS）")
+    parser.add_argument('--lookahead-ms', type=int, default=33, help="発音判定の先読み時間（ミリ秒）")
+    parser.add_argument('--mouth-closed', default='博士 口閉じ.png', help="口閉じ画像")
+    parser.add_argument('--mouth-open', default='博士 口開け.png', help="口開き画像")
+    parser.add_argument('--max-image-size', type=int, default=512, help="最大画像サイズ (px)")
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    cli_args = parse_cli_args(sys.argv[1:])
+    if cli_args.live:
+        run_live_lipsync(
+            cli_args.mouth_closed, cli_args.mouth_open, cli_args.source, cli_args.sink, cli_args.sample_rate,
+            cli_args.channels, cli_args.threshold, cli_args.lookahead_ms, cli_args.max_image_size
+        )
+    elif cli_args.worker:
+        run_spool_worker(
+            cli_args.spool, cli_args.worker_id, cli_args.poll_interval, cli_args.lease_timeout,
+            cli_args.heartbeat_interval, cli_args.max_attempts, cli_args.once, cli_args.debug
+        )
+    else:
+        main() 
\ No newline at end of file